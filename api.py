@@ -0,0 +1,341 @@
+"""
+Headless HTTP API for the chat, image and persistence logic.
+
+Runs next to the Streamlit UI and shares its ChatEngine, so programmatic
+clients get the same behaviour without re-executing a Streamlit script per
+interaction. Chat replies can be streamed as server-sent events.
+
+Run locally with:
+    python api.py
+or in production with a threaded WSGI server, e.g.:
+    gunicorn --worker-class gthread --threads 16 api:app
+"""
+import json
+import os
+import secrets
+import threading
+from collections import OrderedDict
+from datetime import datetime
+from uuid import uuid4
+
+import google.generativeai as genai
+from dotenv import load_dotenv
+from flask import Flask, Response, jsonify, request, send_file, session, stream_with_context
+from flask_session import Session
+
+from chat_engine import ChatEngine, CONTEXT_OPTIONS, RESPONSE_LENGTHS, MODEL_NAME, build_context, get_gemini_api_key
+from image_encoding import DEFAULT_ENCODING_CONFIG, display_path_for
+from mongo_utils import get_chat_history_by_session
+from usage_ledger import BudgetExceeded
+
+load_dotenv()
+
+# Chat sessions kept in memory; the least recently used are dropped beyond this
+MAX_CHAT_SESSIONS = 1000
+# Image jobs whose status is kept for polling
+MAX_IMAGE_JOBS = 1000
+# Seconds to wait for a reply (or, when streaming, for each chunk)
+CHAT_TIMEOUT = 120
+IMAGE_DIR = "generated_images"
+# Bearer token of backend clients allowed to choose their session with X-Session-Id
+API_TOKEN = os.environ.get("API_TOKEN")
+
+app = Flask(__name__)
+app.config["SECRET_KEY"] = os.environ.get("FLASK_SECRET_KEY") or secrets.token_hex(32)
+app.config["SESSION_TYPE"] = os.environ.get("SESSION_TYPE", "filesystem")
+app.config["SESSION_PERMANENT"] = False
+Session(app)
+
+gemini_api_key = get_gemini_api_key()
+if gemini_api_key:
+    genai.configure(api_key=gemini_api_key)
+
+engine = ChatEngine(platform="api", ip_address="api_client", model=MODEL_NAME)
+
+_chats = OrderedDict()
+_image_jobs = OrderedDict()
+_lock = threading.Lock()
+
+
+def _trusted_client():
+    """
+    Whether the request carries the API_TOKEN bearer token. Only such
+    clients may pick their session with X-Session-Id; anyone else is held
+    to the session cookie, so they can't read or spend another
+    session's history and budget by guessing its id.
+    """
+    if not API_TOKEN:
+        return False
+    scheme, _, token = request.headers.get("Authorization", "").partition(" ")
+    return scheme.lower() == "bearer" and secrets.compare_digest(token.encode(), API_TOKEN.encode())
+
+
+def get_session_id():
+    """
+    Session id from the X-Session-Id header (trusted clients without a
+    cookie jar) or the Flask session, creating one if needed
+    """
+    session_id = session.get("session_id")
+    if _trusted_client():
+        session_id = request.headers.get("X-Session-Id") or session_id
+    if not session_id:
+        session_id = str(uuid4())
+    session["session_id"] = session_id
+    return session_id
+
+
+def get_chat(session_id, persona=None, response_length=None):
+    """
+    Return the Gemini chat and its (persona, response_length) settings for a
+    session, starting a new chat if the session is unknown or its persona /
+    response style changed. Raises BudgetExceeded if a new chat can't be
+    primed within the session's budget.
+    """
+    settings = (persona or "Basic Assistant", response_length or "Standard")
+    with _lock:
+        entry = _chats.get(session_id)
+        if entry is not None and ((persona is None and response_length is None) or entry[0] == settings):
+            _chats.move_to_end(session_id)
+            return entry
+
+    chat = engine.start_chat(session_id, build_context(*settings), persona=settings[0], timeout=CHAT_TIMEOUT)
+    with _lock:
+        _chats[session_id] = (settings, chat)
+        _chats.move_to_end(session_id)
+        while len(_chats) > MAX_CHAT_SESSIONS:
+            _chats.popitem(last=False)
+    return settings, chat
+
+
+def _bad_request(message):
+    return jsonify({"error": message}), 400
+
+
+def _settings_error(persona, response_length):
+    # None means "keep the session's current setting"
+    if persona is not None and persona not in CONTEXT_OPTIONS:
+        return f"Unknown persona: {persona}"
+    if response_length is not None and response_length not in RESPONSE_LENGTHS:
+        return f"Unknown response_length: {response_length}"
+    return None
+
+
+def _sse(data, event=None):
+    message = f"data: {json.dumps(data)}\n\n"
+    if event:
+        message = f"event: {event}\n" + message
+    return message
+
+
+@app.get("/api/health")
+def health():
+    return jsonify({"status": "ok"})
+
+
+@app.post("/api/session")
+def create_session():
+    """
+    Start a session (or reset the current one) with an optional persona and response style
+    """
+    body = request.get_json(silent=True) or {}
+    persona = body.get("persona", "Basic Assistant")
+    response_length = body.get("response_length", "Standard")
+    error = _settings_error(persona, response_length)
+    if error:
+        return _bad_request(error)
+
+    session_id = get_session_id()
+    try:
+        get_chat(session_id, persona, response_length)
+    except BudgetExceeded as e:
+        return jsonify({"error": str(e)}), 429
+    except Exception as e:
+        return jsonify({"error": str(e)}), 502
+    return jsonify({"session_id": session_id, "persona": persona, "response_length": response_length})
+
+
+@app.post("/api/chat")
+def chat_message():
+    """
+    Send a message. Replies with JSON, or with server-sent events when the
+    client sends Accept: text/event-stream or "stream": true.
+    """
+    body = request.get_json(silent=True) or {}
+    user_message = (body.get("message") or "").strip()
+    if not user_message:
+        return _bad_request("message is required")
+    error = _settings_error(body.get("persona"), body.get("response_length"))
+    if error:
+        return _bad_request(error)
+
+    session_id = get_session_id()
+    try:
+        (persona, _), chat = get_chat(session_id, body.get("persona"), body.get("response_length"))
+    except BudgetExceeded as e:
+        return jsonify({"error": str(e)}), 429
+    except Exception as e:
+        return jsonify({"error": str(e)}), 502
+
+    stream = body.get("stream") or request.accept_mimetypes.best == "text/event-stream"
+    if not stream:
+        try:
+            bot_response = engine.send_message(chat, session_id, user_message, timeout=CHAT_TIMEOUT, persona=persona)
+        except BudgetExceeded as e:
+            return jsonify({"error": str(e)}), 429
+        except Exception as e:
+            return jsonify({"error": str(e)}), 502
+        return jsonify({"session_id": session_id, "response": bot_response})
+
+    def events():
+        # An interrupted reply (timeout, error or disconnect) is dropped from
+        # the chat by the engine, so the conversation carries on without it
+        yield _sse({"session_id": session_id}, event="start")
+        try:
+            for text in engine.stream_message(chat, session_id, user_message, timeout=CHAT_TIMEOUT, persona=persona):
+                yield _sse({"text": text})
+        except Exception as e:
+            yield _sse({"error": str(e)}, event="error")
+            return
+        yield _sse({}, event="done")
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+
+@app.get("/api/usage")
+def usage():
+    """
+    Token and image usage of the current session, all time and today
+    """
+    session_id = get_session_id()
+    return jsonify({
+        "session_id": session_id,
+        "totals": engine.ledger.totals(session_id),
+        "today": engine.ledger.today(session_id)
+    })
+
+
+@app.get("/api/history")
+def history():
+    session_id = get_session_id()
+    messages = get_chat_history_by_session(session_id)
+    for message in messages:
+        message["timestamp"] = message["timestamp"].isoformat()
+    return jsonify({"session_id": session_id, "messages": messages})
+
+
+@app.post("/api/images")
+def start_image():
+    """
+    Start an image generation job; poll /api/images/<job_id> for its status
+    """
+    body = request.get_json(silent=True) or {}
+    prompt = (body.get("prompt") or "").strip()
+    if not prompt:
+        return _bad_request("prompt is required")
+
+    session_id = get_session_id()
+    with _lock:
+        entry = _chats.get(session_id)
+    persona = entry[0][0] if entry else None
+    job_id = uuid4().hex
+    os.makedirs(IMAGE_DIR, exist_ok=True)
+    output_path = os.path.join(IMAGE_DIR, f"api_{job_id}.png")
+    future = engine.start_image(
+        prompt,
+        output_path,
+        session_id=session_id,
+        user_message=f"generate image: {prompt}",
+        bot_response=f"I've generated an image based on your prompt: '{prompt}'.",
+        persona=persona
+    )
+    with _lock:
+        _image_jobs[job_id] = {
+            "future": future,
+            "prompt": prompt,
+            "session_id": session_id,
+            "timestamp": datetime.utcnow().isoformat()
+        }
+        while len(_image_jobs) > MAX_IMAGE_JOBS:
+            _, old_job = _image_jobs.popitem(last=False)
+            old_job["future"].cancel()
+
+    return jsonify({"job_id": job_id, "status": "pending"}), 202
+
+
+@app.get("/api/images/stats")
+def image_stats():
+    """
+    Image request counters, including upstream generations saved by de-duplication
+    """
+    return jsonify(engine.image_stats())
+
+
+def _get_image_job(job_id):
+    with _lock:
+        job = _image_jobs.get(job_id)
+    if job is None or job["session_id"] != get_session_id():
+        return None
+    return job
+
+
+def _job_status(job):
+    future = job["future"]
+    if not future.done():
+        return "pending", None
+    if future.cancelled():
+        return "cancelled", None
+    try:
+        output_path = future.result()
+    except BudgetExceeded:
+        return "over_budget", None
+    except Exception:
+        output_path = None
+    return ("done", output_path) if output_path else ("failed", None)
+
+
+@app.get("/api/images/<job_id>")
+def image_status(job_id):
+    job = _get_image_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown image job"}), 404
+
+    status, _ = _job_status(job)
+    return jsonify({"job_id": job_id, "status": status, "prompt": job["prompt"], "timestamp": job["timestamp"]})
+
+
+@app.delete("/api/images/<job_id>")
+def cancel_image(job_id):
+    job = _get_image_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown image job"}), 404
+
+    cancelled = engine.cancel([job["future"]])
+    return jsonify({"job_id": job_id, "cancelled": bool(cancelled)})
+
+
+@app.get("/api/images/<job_id>/file")
+def image_file(job_id):
+    """
+    Download the lossless original, or the display rendition with ?rendition=display
+    """
+    job = _get_image_job(job_id)
+    if job is None:
+        return jsonify({"error": "Unknown image job"}), 404
+
+    status, output_path = _job_status(job)
+    if status != "done":
+        return jsonify({"job_id": job_id, "status": status}), 409
+
+    if request.args.get("rendition") == "display":
+        display_path = display_path_for(output_path, DEFAULT_ENCODING_CONFIG["display_format"])
+        if os.path.exists(display_path):
+            return send_file(display_path)
+    return send_file(output_path, mimetype="image/png")
+
+
+if __name__ == "__main__":
+    app.run(host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), threaded=True)
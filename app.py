@@ -6,9 +6,12 @@ import google.generativeai as genai
 from datetime import datetime
 from uuid import uuid4
 import yaml
-from mongo_utils import get_db_connection, store_chat_message, get_chat_history_by_session
-# Import the image generation functionality
-from imagen import generate
+from mongo_utils import get_db_connection, get_chat_history_by_session
+# Chat, image generation and persistence run on the async engine
+from chat_engine import ChatEngine, CONTEXT_OPTIONS, MODEL_NAME, build_context
+from usage_ledger import BudgetExceeded
+from message_store import MessageStore, memory_report
+from image_encoding import DEFAULT_ENCODING_CONFIG, display_path_for
 import base64
 from PIL import Image
 import io
@@ -83,12 +86,20 @@ generation_config = {
 }
 
 # Initialize session state for chat history and settings
-if "chat_history" not in st.session_state:
-    st.session_state.chat_history = []
-
 if "session_id" not in st.session_state:
     st.session_state.session_id = str(uuid4())
 
+# Bounded history; older turns are spilled to MongoDB
+if "chat_history" not in st.session_state:
+    st.session_state.chat_history = MessageStore(st.session_state.session_id)
+
+# Spilled messages loaded back for display: positions start..end of the conversation
+if "earlier_messages" not in st.session_state:
+    st.session_state.earlier_messages = {"start": 0, "end": 0, "messages": []}
+
+# Earlier messages are loaded from MongoDB this many at a time
+HISTORY_PAGE_SIZE = 20
+
 if "settings" not in st.session_state:
     st.session_state.settings = {
         "response_length": "Standard",
@@ -99,29 +110,96 @@ if "settings" not in st.session_state:
 if "generated_images" not in st.session_state:
     st.session_state.generated_images = []
 
-# Different context options for the chatbot
-CONTEXT_OPTIONS = {
-    "Basic Assistant": "You are a helpful, friendly AI assistant. Be concise and clear in your responses.",
-    "Technical Expert": "You are a technical expert AI with deep knowledge of programming and computer science. Provide detailed technical answers with code examples when appropriate.",
-    "Creative Writer": "You are a creative AI writer with a flair for engaging, descriptive language. Be imaginative and inspiring in your responses.",
-    "Professional Consultant": "You are a professional consultant AI with a formal, business-oriented communication style. Provide structured, analytical responses."
-}
+# Image jobs still running on the chat engine
+if "image_jobs" not in st.session_state:
+    st.session_state.image_jobs = []
 
-# Get the current context
-INITIAL_CONTEXT = CONTEXT_OPTIONS[st.session_state.settings["chat_context"]]
+# Seconds to wait for a chat reply before cancelling the request
+CHAT_TIMEOUT = 120
 
-# Initialize Gemini chat
+# One engine (event loop thread) per server process, shared by all sessions
 @st.cache_resource
-def get_gemini_chat(_context, _temp=0.9):
-    model = genai.GenerativeModel(
-        model_name="gemini-1.5-pro",
-        generation_config={"temperature": _temp, "top_p": 0.95, "top_k": 40, "max_output_tokens": 8192},
+def get_chat_engine():
+    return ChatEngine(platform='streamlit', ip_address="streamlit_session", model=MODEL_NAME)
+
+engine = get_chat_engine()
+
+def get_gemini_chat(persona, response_length, temperature=0.9):
+    # One Gemini chat per session, so sessions never queue behind each
+    # other's chat lock; a new persona or response style starts a new chat,
+    # whose priming message is charged to this session
+    settings = (persona, response_length)
+    entry = st.session_state.get("gemini_chat")
+    if entry is None or entry[0] != settings:
+        chat = engine.start_chat(
+            st.session_state.session_id,
+            build_context(persona, response_length),
+            persona=persona,
+            temperature=temperature,
+            timeout=CHAT_TIMEOUT
+        )
+        entry = st.session_state.gemini_chat = (settings, chat)
+    return entry[1]
+
+try:
+    chat = get_gemini_chat(st.session_state.settings["chat_context"], st.session_state.settings["response_length"])
+except BudgetExceeded as e:
+    st.error(f"{e} Please try again later.")
+    st.stop()
+
+def next_image_path():
+    # Unique per job, so a failed or cancelled job never frees a name for reuse
+    img_filename = f"generated_image_{uuid4().hex}.png"
+    
+    # Ensure the directory exists
+    os.makedirs("generated_images", exist_ok=True)
+    return os.path.join("generated_images", img_filename)
+
+def start_image_job(prompt, user_message=None, bot_response=None):
+    img_path = next_image_path()
+    future = engine.start_image(
+        prompt,
+        img_path,
+        session_id=st.session_state.session_id,
+        user_message=user_message,
+        bot_response=bot_response,
+        persona=st.session_state.settings["chat_context"]
     )
-    chat = model.start_chat(history=[])
-    chat.send_message(_context)
-    return chat
+    st.session_state.image_jobs.append({
+        "future": future,
+        "prompt": prompt,
+        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    })
+
+def collect_image_jobs():
+    # Move finished image jobs into the gallery; keep the rest pending
+    pending = []
+    for job in st.session_state.image_jobs:
+        future = job["future"]
+        if not future.done():
+            pending.append(job)
+            continue
+        if future.cancelled():
+            continue
+        try:
+            output_path = future.result()
+        except BudgetExceeded as e:
+            st.warning(f"Image for prompt '{job['prompt']}' was not generated: {e}")
+            continue
+        except Exception as e:
+            output_path = None
+            print(f"Error generating image: {str(e)}")
+        if output_path:
+            st.session_state.generated_images.append({
+                "path": output_path,
+                "prompt": job["prompt"],
+                "timestamp": job["timestamp"]
+            })
+        else:
+            st.warning(f"Failed to generate image for prompt: '{job['prompt']}'")
+    st.session_state.image_jobs = pending
 
-chat = get_gemini_chat(INITIAL_CONTEXT, 0.9)
+collect_image_jobs()
 
 # Function to process messages and update chat history
 def process_message(user_message):
@@ -134,32 +212,12 @@ def process_message(user_message):
             # Display user message in chat
             st.session_state.chat_history.append({"role": "user", "content": user_message})
             
-            # Generate the image
-            with st.spinner("Generating image..."):
-                image_path = process_image_generation_from_chat(image_prompt)
+            # Generate the image in the background; the exchange is stored, as shown, once it is ready
+            bot_response = f"I'm generating an image based on your prompt: '{image_prompt}'. It will appear in the Generated Images tab when it's ready."
+            start_image_job(image_prompt, user_message=user_message, bot_response=bot_response)
             
-            if image_path:
-                # Create response with image
-                bot_response = f"I've generated an image based on your prompt: '{image_prompt}'. You can view it in the Generated Images tab."
-                
-                # Store in session state
-                st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
-                
-                # Store conversation in MongoDB
-                store_chat_message(
-                    st.session_state.session_id, 
-                    user_message, 
-                    bot_response, 
-                    platform='streamlit',
-                    ip_address="streamlit_session",
-                    model='gemini-1.5-pro'
-                )
-                
-                return bot_response
-            else:
-                bot_response = "I encountered an error while trying to generate that image. Please try again with a different description."
-                st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
-                return bot_response
+            st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
+            return bot_response
         
         # Handle regular chat messages
         # Display user message in chat
@@ -167,23 +225,23 @@ def process_message(user_message):
         
         # Show a spinner while waiting for the response
         with st.spinner("Thinking..."):
-            # Get response from Gemini
-            response = chat.send_message(user_message)
-            bot_response = response.text.strip()
+            # Get response from Gemini; the engine stores it in MongoDB in the background
+            bot_response = engine.send_message(
+                chat,
+                st.session_state.session_id,
+                user_message,
+                timeout=CHAT_TIMEOUT,
+                persona=st.session_state.settings["chat_context"]
+            )
         
         # Store in session state
         st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
         
-        # Store conversation in MongoDB using our utility function
-        store_chat_message(
-            st.session_state.session_id, 
-            user_message, 
-            bot_response, 
-            platform='streamlit',
-            ip_address="streamlit_session",
-            model='gemini-1.5-pro'
-        )
-        
+        return bot_response
+    except BudgetExceeded as e:
+        # Over budget: nothing was sent to Gemini
+        bot_response = f"{e} Please try again later."
+        st.session_state.chat_history.append({"role": "assistant", "content": bot_response})
         return bot_response
     except Exception as e:
         st.error(f"Error: {str(e)}")
@@ -222,26 +280,16 @@ with col2:
         
         # Apply settings button
         if st.sidebar.button("Apply Settings"):
-            # Update settings
+            # Update settings; the rerun starts a chat primed with them
             st.session_state.settings["chat_context"] = selected_context
             st.session_state.settings["response_length"] = selected_length
             
-            # Re-initialize chat with new settings
-            new_context = CONTEXT_OPTIONS[selected_context]
-            if selected_length == "Concise":
-                new_context += " Keep your responses very brief and to the point."
-            elif selected_length == "Detailed":
-                new_context += " Provide detailed, comprehensive responses."
-                
-            # Reinitialize the chat with new context (using default temperature)
-            chat = get_gemini_chat(new_context, 0.9)
-            
             st.sidebar.success("Settings applied!")
             st.rerun()
         
         # Clear chat button with confirmation
         if st.sidebar.button("Clear Chat History", type="secondary"):
-            st.session_state.chat_history = []
+            st.session_state.chat_history.clear()
             st.sidebar.success("Chat history cleared!")
             st.rerun()
     
@@ -251,30 +299,12 @@ with col2:
                                    placeholder="An Indian Temple with a beautiful sunset")
         
         if st.button("Generate Image"):
-            with st.spinner("Generating image..."):
-                try:
-                    # Generate a unique filename for each image
-                    img_filename = f"generated_image_{len(st.session_state.generated_images)}.png"
-                    img_path = os.path.join("generated_images", img_filename)
-                    
-                    # Ensure the directory exists
-                    os.makedirs("generated_images", exist_ok=True)
-                    
-                    # Generate the image
-                    output_path = generate(prompt_text=image_prompt, output_path=img_path)
-                    
-                    if output_path:
-                        # Add to session state
-                        st.session_state.generated_images.append({
-                            "path": output_path,
-                            "prompt": image_prompt,
-                            "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                        })
-                        st.success("Image generated successfully!")
-                    else:
-                        st.error("Failed to generate image.")
-                except Exception as e:
-                    st.error(f"Error generating image: {str(e)}")
+            try:
+                # Runs on the chat engine so chatting continues while it generates
+                start_image_job(image_prompt)
+                st.success("Image generation started! It will appear in the Generated Images tab.")
+            except Exception as e:
+                st.error(f"Error generating image: {str(e)}")
     
     # Information section
     st.sidebar.markdown("---")
@@ -288,6 +318,22 @@ with col2:
     
     Your chat history is stored in MongoDB for future reference.
     """)
+    
+    # Chat history memory held by this server process, for capacity planning
+    with st.sidebar.expander("Memory usage"):
+        report = memory_report()
+        st.write(f"Sessions: {report['sessions']}")
+        st.write(f"Total: {report['total_bytes'] / 1024:.1f} KiB")
+        st.write(f"Per session: {report['mean_bytes'] / 1024:.1f} KiB mean, {report['max_bytes'] / 1024:.1f} KiB max")
+        st.write(f"This session: {st.session_state.chat_history.memory_bytes() / 1024:.1f} KiB")
+    
+    # Token usage of this session, read from the engine's in-memory ledger
+    with st.sidebar.expander("Usage"):
+        usage = engine.ledger.totals(st.session_state.session_id)
+        today = engine.ledger.today(st.session_state.session_id)
+        st.write(f"Tokens: {usage['total_tokens']:,} ({usage['prompt_tokens']:,} prompt, {usage['output_tokens']:,} output)")
+        st.write(f"Images: {usage['images']}")
+        st.write(f"Today: {today['total_tokens']:,} tokens, {today['images']} images")
 
 with col1:
     # Simplify main chat area
@@ -301,8 +347,30 @@ with col1:
         if not st.session_state.chat_history:
             st.info("Welcome to Gemini AI Chat! Start a conversation by typing a message below.")
 
+        # Older messages are paged back from MongoDB a window at a time, only when asked for
+        history = st.session_state.chat_history
+        earlier = st.session_state.earlier_messages
+        if not earlier["messages"] or history.spilled_count < earlier["end"]:
+            # Nothing loaded yet, or the history was cleared since
+            earlier.update(start=history.spilled_count, end=history.spilled_count, messages=[])
+        elif history.spilled_count > earlier["end"]:
+            # More turns were spilled since; fetch them so the loaded window stays contiguous
+            earlier["messages"] += history.page(earlier["end"], history.spilled_count)
+            earlier["end"] = history.spilled_count
+        if earlier["start"] or earlier["messages"]:
+            load_col, hide_col = st.columns([3, 1])
+            if earlier["start"] and load_col.button(f"Load earlier messages ({earlier['start']} more)"):
+                start = max(0, earlier["start"] - HISTORY_PAGE_SIZE)
+                earlier["messages"] = history.page(start, earlier["start"]) + earlier["messages"]
+                earlier["start"] = start
+                st.rerun()
+            if earlier["messages"] and hide_col.button("Hide earlier messages"):
+                earlier["messages"] = []
+                st.rerun()
+        messages = earlier["messages"] + list(history)
+        
         # Display chat messages with improved styling
-        for i, message in enumerate(st.session_state.chat_history):
+        for i, message in enumerate(messages):
             if message["role"] == "user":
                 with st.chat_message("user", avatar="👤"):
                     st.write(message["content"])
@@ -318,7 +386,23 @@ with col1:
     with images_tab:
         st.title("🖼️ Generated Images")
         
-        if not st.session_state.generated_images:
+        # Identical prompts share one generation across sessions on this server
+        image_stats = engine.image_stats()
+        if image_stats["saved"]:
+            st.caption(f"{image_stats['saved']} of {image_stats['requests']} image requests were served without a new generation.")
+        
+        if st.session_state.image_jobs:
+            st.info(f"{len(st.session_state.image_jobs)} image(s) still generating...")
+            refresh_col, cancel_col = st.columns(2)
+            with refresh_col:
+                if st.button("Refresh"):
+                    st.rerun()
+            with cancel_col:
+                if st.button("Cancel pending images"):
+                    engine.cancel([job["future"] for job in st.session_state.image_jobs])
+                    st.rerun()
+        
+        if not st.session_state.generated_images and not st.session_state.image_jobs:
             st.info("No images generated yet. Use the Image Generation tab in the sidebar to create images.")
         else:
             # Display generated images in a grid
@@ -328,7 +412,11 @@ with col1:
                 col_idx = i % 2
                 with cols[col_idx]:
                     try:
-                        st.image(img_data["path"], caption=f"Prompt: {img_data['prompt']}")
+                        # Show the lightweight rendition; download serves the lossless original
+                        display_path = display_path_for(img_data["path"], DEFAULT_ENCODING_CONFIG["display_format"])
+                        if not os.path.exists(display_path):
+                            display_path = img_data["path"]
+                        st.image(display_path, caption=f"Prompt: {img_data['prompt']}")
                         st.caption(f"Generated on: {img_data['timestamp']}")
                         # Add a download button
                         with open(img_data["path"], "rb") as file:
@@ -340,29 +428,3 @@ with col1:
                             )
                     except Exception as e:
                         st.error(f"Error displaying image {i+1}: {str(e)}")
-
-# Add a function to handle image generation from chat context
-def process_image_generation_from_chat(prompt):
-    try:
-        # Generate a unique filename
-        img_filename = f"generated_image_{len(st.session_state.generated_images)}.png"
-        img_path = os.path.join("generated_images", img_filename)
-        
-        # Ensure the directory exists
-        os.makedirs("generated_images", exist_ok=True)
-        
-        # Generate the image
-        output_path = generate(prompt_text=prompt, output_path=img_path)
-        
-        if output_path:
-            # Add to session state
-            st.session_state.generated_images.append({
-                "path": output_path,
-                "prompt": prompt,
-                "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            })
-            return output_path
-        return None
-    except Exception as e:
-        print(f"Error generating image from chat: {str(e)}")
-        return None
\ No newline at end of file
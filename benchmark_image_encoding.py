@@ -0,0 +1,56 @@
+"""
+Benchmark display encodings: encode time vs bytes saved.
+
+Usage:
+    python benchmark_image_encoding.py [image ...]
+
+Defaults to generated_image.png and everything in generated_images/.
+"""
+import glob
+import os
+import sys
+import time
+
+from PIL import Image
+
+from image_encoding import DEFAULT_ENCODING_CONFIG, encode_display, encode_original, supported_display_format
+
+FORMATS = ["WEBP", "AVIF", "JPEG"]
+BUDGETS = [75 * 1024, 150 * 1024, 300 * 1024]
+
+
+def benchmark(path):
+    image = Image.open(path)
+    image.load()
+    source_bytes = os.path.getsize(path)
+
+    print(f"\n{path}: {image.size[0]}x{image.size[1]} {image.mode}, {source_bytes / 1024:.0f} KiB")
+    print(f"{'rendition':<22}{'KiB':>8}{'saved':>8}{'quality':>9}{'size':>12}{'ms':>9}")
+
+    start = time.perf_counter()
+    original = encode_original(image)
+    elapsed = (time.perf_counter() - start) * 1000
+    saved = 1 - len(original) / source_bytes
+    print(f"{'PNG (lossless)':<22}{len(original) / 1024:>8.0f}{saved:>8.0%}{'-':>9}{'':>12}{elapsed:>9.0f}")
+
+    for display_format in FORMATS:
+        if supported_display_format(display_format) != display_format:
+            print(f"{display_format:<22}not supported by this Pillow build")
+            continue
+        for budget in BUDGETS:
+            config = {**DEFAULT_ENCODING_CONFIG, "display_format": display_format, "display_budget": budget}
+            start = time.perf_counter()
+            result = encode_display(image, config)
+            elapsed = (time.perf_counter() - start) * 1000
+            saved = 1 - result["bytes"] / source_bytes
+            label = f"{display_format} <= {budget // 1024} KiB"
+            size = f"{result['size'][0]}x{result['size'][1]}"
+            print(f"{label:<22}{result['bytes'] / 1024:>8.0f}{saved:>8.0%}{result['quality']:>9}{size:>12}{elapsed:>9.0f}")
+
+
+if __name__ == "__main__":
+    paths = sys.argv[1:] or ["generated_image.png"] + sorted(glob.glob("generated_images/*.png"))
+    for path in paths:
+        if ".display." in path or not os.path.exists(path):
+            continue
+        benchmark(path)
@@ -0,0 +1,491 @@
+"""
+Asyncio engine behind the Streamlit chat UI and the HTTP API.
+
+Streamlit re-executes app.py on every interaction, so the engine owns a
+long-lived event loop running in a daemon thread. Gemini calls, image
+generation and MongoDB writes are scheduled on that loop and overlap with
+each other; the Streamlit and Flask layers only submit work and collect
+results.
+"""
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+import weakref
+from datetime import datetime
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from uuid import uuid4
+
+import google.generativeai as genai
+import yaml
+
+from mongo_utils import (
+    get_async_db_connection,
+    build_chat_document,
+    store_chat_document_async,
+    store_usage_entries_async,
+    load_usage_totals_async,
+)
+from chat_spool import get_spool
+from image_encoding import DEFAULT_ENCODING_CONFIG, display_path_for
+from imagen import generate_async, request_key, MODEL_NAME as IMAGE_MODEL_NAME
+from shared_cache import get_cache_backend
+from usage_ledger import UsageLedger
+
+MODEL_NAME = "gemini-1.5-pro"
+
+# Seconds a chatrecords insert may take before the record goes to the local spool
+PERSIST_TIMEOUT = 2.0
+# After a failed insert, records go straight to the spool for this many seconds
+DB_RETRY_INTERVAL = 30.0
+
+# Seconds recent image results are served without a new generation, shared
+# by every process through the shared_cache backend; 0 disables the cache
+IMAGE_CACHE_TTL = 15 * 60
+# Cached results are written back here under names derived from the request key
+IMAGE_DIR = "generated_images"
+
+# Different context options for the chatbot
+CONTEXT_OPTIONS = {
+    "Basic Assistant": "You are a helpful, friendly AI assistant. Be concise and clear in your responses.",
+    "Technical Expert": "You are a technical expert AI with deep knowledge of programming and computer science. Provide detailed technical answers with code examples when appropriate.",
+    "Creative Writer": "You are a creative AI writer with a flair for engaging, descriptive language. Be imaginative and inspiring in your responses.",
+    "Professional Consultant": "You are a professional consultant AI with a formal, business-oriented communication style. Provide structured, analytical responses."
+}
+
+RESPONSE_LENGTHS = {
+    "Concise": " Keep your responses very brief and to the point.",
+    "Standard": "",
+    "Detailed": " Provide detailed, comprehensive responses."
+}
+
+
+def get_gemini_api_key():
+    """
+    Get the Gemini API key from environment variables or app.yaml
+    """
+    gemini_api_key = os.environ.get('GEMINI_API_KEY')
+
+    if not gemini_api_key:
+        try:
+            with open('app.yaml', 'r') as yaml_file:
+                config = yaml.safe_load(yaml_file)
+                env_vars = config.get('env_variables', {})
+                gemini_api_key = env_vars.get('GEMINI_API_KEY')
+        except Exception:
+            pass
+
+    return gemini_api_key
+
+
+def build_context(persona="Basic Assistant", response_length="Standard"):
+    """
+    Build the system context for a persona and response style
+    """
+    return CONTEXT_OPTIONS[persona] + RESPONSE_LENGTHS.get(response_length, "")
+
+
+def create_chat(context, temperature=0.9, prime=True):
+    """
+    Start a Gemini chat session primed with context. With prime=False the
+    context is not sent yet; ChatEngine.start_chat sends it so the priming
+    call is budgeted and charged like any other turn.
+    """
+    model = genai.GenerativeModel(
+        model_name=MODEL_NAME,
+        generation_config={"temperature": temperature, "top_p": 0.95, "top_k": 40, "max_output_tokens": 8192},
+    )
+    chat = model.start_chat(history=[])
+    if prime:
+        chat.send_message(context)
+    return chat
+
+
+class ChatEngine:
+    """
+    Runs chat turns, image jobs and chat persistence on one event loop
+    """
+
+    def __init__(self, platform="streamlit", ip_address="streamlit_session", model=MODEL_NAME, persist=True,
+                 image_cache_ttl=IMAGE_CACHE_TTL, image_dir=IMAGE_DIR, ledger=None, image_generator=None):
+        self.platform = platform
+        self.ip_address = ip_address
+        self.model = model
+        # Load tests can turn off MongoDB writes
+        self.persist = persist
+        self._collection = None
+        self._db_down_until = 0.0
+        # Token and image usage per session, with budget checks
+        self.ledger = ledger or UsageLedger()
+        # Background persistence tasks; only touched from the loop thread
+        self._background = set()
+        # A Gemini ChatSession appends to its history on every turn, so turns
+        # on the same chat are serialised; different chats run concurrently
+        self._chat_locks = weakref.WeakKeyDictionary()
+        # Single-flight image generation: in-flight requests by request key;
+        # recent results live in the shared cache
+        self.image_cache_ttl = image_cache_ttl
+        self.image_dir = image_dir
+        # Coroutine function with imagen.generate_async's signature; load tests pass a fake
+        self.image_generator = image_generator or generate_async
+        self._image_flights = {}
+        self._image_stats = {"requests": 0, "upstream_calls": 0, "coalesced": 0, "cache_hits": 0}
+        if persist:
+            # Start the spool's replayer now, so records left by an earlier
+            # process are stored without waiting for an insert to fail
+            get_spool()
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chat-engine", daemon=True)
+        self._thread.start()
+        atexit.register(self.shutdown)
+
+    def run(self, coro, timeout=None):
+        """
+        Run a coroutine on the engine loop and wait for its result.
+        The coroutine is cancelled if it does not finish within timeout seconds.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._loop)
+        try:
+            return future.result(timeout)
+        except FutureTimeoutError:
+            future.cancel()
+            raise
+
+    def submit(self, coro):
+        """
+        Schedule a coroutine on the engine loop and return a concurrent.futures.Future
+        """
+        return asyncio.run_coroutine_threadsafe(coro, self._loop)
+
+    def start_chat(self, session_id, context, persona=None, temperature=0.9, timeout=None):
+        """
+        Start a Gemini chat primed with context. The priming message counts
+        against session_id's budget like a chat turn and raises
+        BudgetExceeded if the session is over it.
+        """
+        chat = create_chat(context, temperature, prime=False)
+        return self.run(self.prime_chat(chat, session_id, context, persona), timeout)
+
+    def send_message(self, chat, session_id, user_message, timeout=None, persona=None):
+        """
+        Send a chat turn and block until Gemini answers. The exchange is
+        stored in MongoDB in the background once the reply is available.
+        Raises BudgetExceeded if the session is over its usage budget.
+        """
+        return self.run(self.chat_turn(chat, session_id, user_message, persona), timeout)
+
+    def stream_message(self, chat, session_id, user_message, timeout=None, persona=None):
+        """
+        Send a chat turn and yield the reply text as Gemini streams it.
+        Closing the generator early (e.g. a disconnected client) cancels the
+        upstream request and drops the unfinished turn, so the chat stays
+        usable. timeout applies to each chunk.
+        """
+        stream = self.stream_turn(chat, session_id, user_message, persona)
+        try:
+            while True:
+                try:
+                    yield self.run(_next_chunk(stream), timeout)
+                except StopAsyncIteration:
+                    return
+        finally:
+            self.run(stream.aclose(), timeout)
+
+    def start_image(self, prompt, output_path, session_id=None, user_message=None, bot_response=None, persona=None):
+        """
+        Start generating an image without waiting for it. Returns a future
+        resolving to the saved path (or None). If user_message is given, the
+        exchange is stored in MongoDB when the image is ready. The future
+        raises BudgetExceeded if the session is over its usage budget.
+        """
+        return self.submit(self.image_job(prompt, output_path, session_id, user_message, bot_response, persona))
+
+    def image_stats(self):
+        """
+        Counters for image requests; "saved" is how many upstream
+        generations were avoided by coalescing and the result cache
+        """
+        stats = dict(self._image_stats)
+        stats["saved"] = stats["coalesced"] + stats["cache_hits"]
+        return stats
+
+    def cancel(self, futures):
+        """
+        Cancel pending engine futures, e.g. image jobs the user no longer wants
+        """
+        cancelled = 0
+        for future in futures:
+            if future.cancel():
+                cancelled += 1
+        return cancelled
+
+    def shutdown(self, timeout=5):
+        """
+        Wait for outstanding MongoDB writes and stop the event loop
+        """
+        if not self._loop.is_running():
+            return
+        try:
+            self.run(self._drain(), timeout)
+        except Exception as e:
+            logging.error(f"Error draining chat engine: {e}")
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join(timeout)
+
+    async def prime_chat(self, chat, session_id, context, persona=None):
+        await self._check_budget(session_id, "chat")
+        async with self._lock_for(chat):
+            response = await chat.send_message_async(context)
+        self._record_chat_usage(session_id, persona, response)
+        return chat
+
+    async def chat_turn(self, chat, session_id, user_message, persona=None):
+        await self._check_budget(session_id, "chat")
+        async with self._lock_for(chat):
+            response = await chat.send_message_async(user_message)
+        self._record_chat_usage(session_id, persona, response)
+        bot_response = response.text.strip()
+        self._spawn(self._persist(session_id, user_message, bot_response))
+        return bot_response
+
+    async def stream_turn(self, chat, session_id, user_message, persona=None):
+        await self._check_budget(session_id, "chat")
+        parts = []
+        finished = False
+        async with self._lock_for(chat):
+            history = list(chat.history)
+            response = await chat.send_message_async(user_message, stream=True)
+            try:
+                async for chunk in response:
+                    parts.append(chunk.text)
+                    yield chunk.text
+                finished = True
+            finally:
+                # Tokens already streamed are charged even if the client went away
+                self._record_chat_usage(session_id, persona, response)
+                if not finished:
+                    # Drop the unfinished turn, or every later message raises
+                    # IncompleteIterationError. rewind() can't be used: it
+                    # reads the unfinished response and raises the same error.
+                    chat.history = history
+        bot_response = "".join(parts).strip()
+        self._spawn(self._persist(session_id, user_message, bot_response))
+
+    async def image_job(self, prompt, output_path, session_id=None, user_message=None, bot_response=None, persona=None):
+        output_path = await self._generate_image(prompt, output_path, session_id, persona)
+        if output_path and session_id is not None and user_message is not None:
+            self._spawn(self._persist(session_id, user_message, bot_response))
+        return output_path
+
+    async def _check_budget(self, session_id, kind):
+        # Seed the in-memory totals from the ledger collection once per session.
+        # While MongoDB is marked down the read is skipped so chat latency
+        # doesn't depend on database health; the check then uses what this
+        # process has seen, and the read is retried once MongoDB is back.
+        if self.persist and not self.ledger.is_loaded(session_id) and time.monotonic() >= self._db_down_until:
+            try:
+                collection = await self._get_collection()
+                totals = today = None
+                if collection is not None:
+                    day_start = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+                    totals, today = await asyncio.wait_for(
+                        load_usage_totals_async(collection.database, session_id, day_start),
+                        PERSIST_TIMEOUT
+                    )
+                self.ledger.load(session_id, totals, today)
+            except Exception as e:
+                # Left unloaded, so a later request reads the earlier usage again
+                logging.warning(f"Could not load usage for session {session_id}, will retry: {e!r}")
+                self._db_down_until = time.monotonic() + DB_RETRY_INTERVAL
+        self.ledger.check(session_id, kind)
+
+    def _record_chat_usage(self, session_id, persona, response):
+        try:
+            usage = response.usage_metadata
+        except Exception:
+            # An interrupted stream may not have reported usage yet
+            usage = None
+        self.ledger.record(
+            session_id,
+            persona,
+            self.model,
+            "chat",
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or 0,
+            output_tokens=getattr(usage, "candidates_token_count", 0) or 0
+        )
+
+    async def _generate_image(self, prompt, output_path, session_id=None, persona=None):
+        # Identical requests share one upstream generation and its file
+        key = request_key(prompt)
+        self._image_stats["requests"] += 1
+
+        if self.image_cache_ttl and key not in self._image_flights:
+            cached_path = await asyncio.to_thread(self._load_cached_image, key)
+            if cached_path:
+                self._image_stats["cache_hits"] += 1
+                return cached_path
+
+        flight = self._image_flights.get(key)
+        if flight is None and session_id is not None:
+            # Only a new upstream generation counts against the budget
+            await self._check_budget(session_id, "image")
+            flight = self._image_flights.get(key)
+        if flight is None:
+            usage = {}
+            task = asyncio.create_task(self.image_generator(prompt_text=prompt, output_path=output_path, usage=usage))
+            flight = self._image_flights[key] = {"task": task, "waiters": 0}
+            task.add_done_callback(lambda task: self._finish_image_flight(key, task, session_id, persona, usage))
+            self._image_stats["upstream_calls"] += 1
+        else:
+            self._image_stats["coalesced"] += 1
+
+        flight["waiters"] += 1
+        try:
+            # Shielded so one cancelled requester doesn't cancel the others' generation
+            return await asyncio.shield(flight["task"])
+        except asyncio.CancelledError:
+            if flight["waiters"] == 1:
+                flight["task"].cancel()
+            raise
+        finally:
+            flight["waiters"] -= 1
+
+    def _finish_image_flight(self, key, task, session_id, persona, usage):
+        if self._image_flights.get(key, {}).get("task") is task:
+            del self._image_flights[key]
+        if session_id is not None and (usage or (not task.cancelled() and task.exception() is None)):
+            # The upstream call is charged to the session that started it
+            self.ledger.record(
+                session_id,
+                persona,
+                IMAGE_MODEL_NAME,
+                "image",
+                prompt_tokens=usage.get("prompt_tokens", 0),
+                output_tokens=usage.get("output_tokens", 0),
+                images=1 if not task.cancelled() and task.exception() is None and task.result() else 0
+            )
+        if task.cancelled() or task.exception() is not None or not task.result():
+            return
+        if self.image_cache_ttl:
+            self._spawn(asyncio.to_thread(self._store_cached_image, key, task.result()))
+
+    def _load_cached_image(self, key):
+        # Cached files are written under the request key, so a path never
+        # holds the image of a different request; runs in a worker thread
+        try:
+            cached = get_cache_backend().get(f"imagen:{key}")
+        except Exception as e:
+            logging.error(f"Error reading image cache: {e}")
+            return None
+        if cached is None:
+            return None
+        os.makedirs(self.image_dir, exist_ok=True)
+        for suffix, data in cached["files"].items():
+            path = os.path.join(self.image_dir, key + suffix)
+            if not os.path.exists(path):
+                partial = f"{path}.{uuid4().hex}.partial"
+                with open(partial, "wb") as f:
+                    f.write(data)
+                os.replace(partial, path)
+        return os.path.join(self.image_dir, key + cached["extension"])
+
+    def _store_cached_image(self, key, output_path):
+        # Cache the original and its display rendition; runs in a worker thread
+        root, extension = os.path.splitext(output_path)
+        files = {}
+        for path in (output_path, display_path_for(output_path, DEFAULT_ENCODING_CONFIG["display_format"])):
+            if os.path.exists(path):
+                with open(path, "rb") as f:
+                    files[path[len(root):]] = f.read()
+        if extension not in files:
+            return
+        try:
+            get_cache_backend().set(f"imagen:{key}", {"extension": extension, "files": files}, self.image_cache_ttl)
+        except Exception as e:
+            logging.error(f"Error caching image for {output_path}: {e}")
+
+    def _lock_for(self, chat):
+        # Only called on the loop thread, so no extra locking is needed
+        lock = self._chat_locks.get(chat)
+        if lock is None:
+            lock = self._chat_locks[chat] = asyncio.Lock()
+        return lock
+
+    async def _get_collection(self):
+        if self._collection is None:
+            _, self._collection = get_async_db_connection()
+        return self._collection
+
+    async def _persist(self, session_id, user_message, bot_response):
+        if not self.persist:
+            return
+        try:
+            collection = await self._get_collection()
+        except Exception as e:
+            logging.error(f"Error connecting to MongoDB: {e}")
+            return
+        if collection is None:
+            return
+        
+        chat_document = build_chat_document(
+            session_id,
+            user_message,
+            bot_response,
+            platform=self.platform,
+            ip_address=self.ip_address,
+            model=self.model
+        )
+        if time.monotonic() >= self._db_down_until:
+            try:
+                await asyncio.wait_for(store_chat_document_async(collection, chat_document), PERSIST_TIMEOUT)
+            except Exception as e:
+                logging.warning(f"MongoDB write failed or timed out, spooling chat record: {e!r}")
+                self._db_down_until = time.monotonic() + DB_RETRY_INTERVAL
+            else:
+                try:
+                    await self._flush_usage(collection)
+                except Exception as e:
+                    logging.warning(f"Error storing usage ledger, will retry: {e!r}")
+                return
+        # The spool replays the record once MongoDB recovers; the preassigned _id keeps it idempotent
+        get_spool().append(chat_document)
+
+    async def _flush_usage(self, collection):
+        # Usage entries ride along with chat record writes in one batch
+        entries = self.ledger.take_pending()
+        if not entries:
+            return
+        try:
+            failed = await asyncio.wait_for(store_usage_entries_async(collection.database, entries), PERSIST_TIMEOUT)
+        except Exception:
+            # Some entries may have landed before the error; their _id makes the retry skip them
+            self.ledger.restore_pending(entries)
+            raise
+        if failed:
+            logging.warning(f"{len(failed)} of {len(entries)} usage entries were not stored, will retry")
+            self.ledger.restore_pending(failed)
+
+    def _spawn(self, coro):
+        # Keep a reference so the task is not garbage collected mid-write
+        task = asyncio.create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+        return task
+
+    async def _drain(self):
+        if self._background:
+            await asyncio.gather(*self._background, return_exceptions=True)
+        if self.persist:
+            try:
+                collection = await self._get_collection()
+                if collection is not None:
+                    await self._flush_usage(collection)
+            except Exception as e:
+                logging.error(f"Error storing usage ledger: {e!r}")
+
+
+async def _next_chunk(stream):
+    return await stream.__anext__()
+
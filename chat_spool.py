@@ -0,0 +1,258 @@
+"""
+Durable local spool for chat records when MongoDB is slow or down.
+
+Records that cannot be stored promptly are appended to a JSON-lines file.
+A writer thread batches appends and fsyncs once per batch, so spooling
+costs the chat path nothing but a list append. A replayer thread
+periodically moves the spool aside and bulk-inserts it into chatrecords.
+Every record carries its _id from the start, so a record that reached
+MongoDB after a timeout, or a file replayed twice after a crash, is
+skipped as a duplicate instead of being stored again.
+
+The Streamlit app and the HTTP API may share one spool directory, so
+writes and rotation take an flock on spool.lock, and only one process at
+a time drains (drain.lock).
+"""
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+
+from bson import ObjectId
+from pymongo.errors import BulkWriteError
+
+from mongo_utils import DUPLICATE_KEY, get_db_connection
+
+DEFAULT_SPOOL_DIR = ".spool"
+
+
+def _encode(document):
+    record = dict(document)
+    record["_id"] = str(record["_id"])
+    record["timestamp"] = record["timestamp"].isoformat()
+    return json.dumps(record) + "\n"
+
+
+def _decode(line):
+    record = json.loads(line)
+    record["_id"] = ObjectId(record["_id"])
+    record["timestamp"] = datetime.fromisoformat(record["timestamp"])
+    return record
+
+
+@contextmanager
+def _flock(path, blocking=True):
+    """
+    Hold an exclusive lock on path across processes. Without blocking,
+    raises BlockingIOError if another process holds it.
+    """
+    with open(path, "a") as f:
+        fcntl.flock(f, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+class ChatSpool:
+    """
+    Append-only spool of chat documents with a background replayer
+    """
+
+    def __init__(self, directory=None, flush_interval=0.2, batch_size=100, retry_interval=10.0, insert_batch_size=500, timeout_ms=2000,
+                 write_retry_interval=1.0):
+        directory = directory or os.environ.get("CHAT_SPOOL_DIR", DEFAULT_SPOOL_DIR)
+        self.directory = directory
+        self.active_path = os.path.join(directory, "chatrecords.jsonl")
+        self.lock_path = os.path.join(directory, "spool.lock")
+        self.drain_lock_path = os.path.join(directory, "drain.lock")
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.retry_interval = retry_interval
+        self.write_retry_interval = write_retry_interval
+        self.insert_batch_size = insert_batch_size
+        self.timeout_ms = timeout_ms
+        # Counters for monitoring
+        self.spooled = 0
+        self.replayed = 0
+
+        os.makedirs(directory, exist_ok=True)
+        self._buffer = []
+        self._cond = threading.Condition()
+        # Guards the active file against being rotated mid-write (with spool.lock across processes)
+        self._file_lock = threading.Lock()
+        # Only one drain at a time (with drain.lock across processes)
+        self._drain_lock = threading.Lock()
+        self._closed = False
+        self._stop = threading.Event()
+
+        self._writer = threading.Thread(target=self._write_loop, name="chat-spool-writer", daemon=True)
+        self._writer.start()
+        self._replayer = threading.Thread(target=self._replay_loop, name="chat-spool-replayer", daemon=True)
+        self._replayer.start()
+        atexit.register(self.close)
+
+    def append(self, document):
+        """
+        Queue a chat document for the spool file. Returns immediately; the
+        writer thread makes it durable within flush_interval seconds.
+        """
+        line = _encode(document)
+        with self._cond:
+            self.spooled += 1
+            if not self._closed:
+                self._buffer.append(line)
+                # Wake the writer for the first record of a batch (it then
+                # waits up to flush_interval for more) and for a full batch
+                if len(self._buffer) == 1 or len(self._buffer) >= self.batch_size:
+                    self._cond.notify()
+                return
+        # The writer has stopped (e.g. during interpreter exit), so write directly
+        self._write([line])
+
+    def pending(self):
+        """
+        Number of spooled bytes not yet replayed into MongoDB
+        """
+        paths = glob.glob(os.path.join(self.directory, "chatrecords*"))
+        return sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+
+    def close(self, timeout=5):
+        """
+        Flush buffered records to disk and stop the background threads
+        """
+        with self._cond:
+            if self._closed:
+                return
+            self._closed = True
+            self._cond.notify()
+        self._stop.set()
+        self._writer.join(timeout)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                if not self._buffer and not self._closed:
+                    self._cond.wait()
+                if self._buffer and len(self._buffer) < self.batch_size and not self._closed:
+                    # Group commit: give other records a moment to join this fsync
+                    self._cond.wait(self.flush_interval)
+                lines, self._buffer = self._buffer, []
+                closed = self._closed
+            if lines:
+                try:
+                    self._write(lines)
+                except Exception as e:
+                    if closed:
+                        logging.error(f"Error writing {len(lines)} records to chat spool at shutdown, they are lost: {e}")
+                        return
+                    # Keep the batch ahead of newer records and try again after a pause;
+                    # a partly written batch is rewritten, and replay skips the duplicates
+                    logging.error(f"Error writing {len(lines)} records to chat spool, will retry: {e}")
+                    with self._cond:
+                        self._buffer[:0] = lines
+                    self._stop.wait(self.write_retry_interval)
+            elif closed:
+                return
+
+    def _write(self, lines):
+        with self._file_lock, _flock(self.lock_path):
+            with open(self.active_path, "a", encoding="utf-8") as f:
+                f.write("".join(lines))
+                f.flush()
+                os.fsync(f.fileno())
+
+    def _replay_loop(self):
+        while not self._stop.wait(self.retry_interval):
+            try:
+                self.drain()
+            except Exception as e:
+                logging.error(f"Error draining chat spool: {e}")
+
+    def drain(self):
+        """
+        Replay spooled records into MongoDB with bulk inserts. Files are
+        removed only after every record in them is stored; the first
+        failure stops the drain until the next attempt. Returns the number
+        of records replayed, or 0 if another process is draining.
+        """
+        with self._drain_lock:
+            try:
+                with _flock(self.drain_lock_path, blocking=False):
+                    return self._drain()
+            except BlockingIOError:
+                return 0
+
+    def _drain(self):
+        draining = sorted(glob.glob(os.path.join(self.directory, "chatrecords.*.draining")))
+        if not draining:
+            # Rotate only once earlier files are stored, so an outage keeps appending to one file
+            with self._file_lock, _flock(self.lock_path):
+                if os.path.exists(self.active_path) and os.path.getsize(self.active_path):
+                    path = os.path.join(self.directory, f"chatrecords.{time.time_ns()}.draining")
+                    os.replace(self.active_path, path)
+                    draining.append(path)
+
+        replayed = 0
+        for path in draining:
+            try:
+                replayed += self._drain_file(path)
+            except Exception as e:
+                logging.warning(f"MongoDB unavailable, keeping {path} for the next attempt: {e}")
+                break
+            os.remove(path)
+        self.replayed += replayed
+        return replayed
+
+    def _drain_file(self, path):
+        documents = []
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    documents.append(_decode(line))
+                except ValueError as e:
+                    # A torn final line from a crash mid-write
+                    logging.error(f"Skipping unreadable spool record in {path}: {e}")
+        if not documents:
+            return 0
+
+        _, collection = get_db_connection(timeout_ms=self.timeout_ms)
+        if collection is None:
+            raise RuntimeError("MongoDB is not configured")
+        for start in range(0, len(documents), self.insert_batch_size):
+            # stored_at is the replay time, so the rollups pick up records however late they arrive
+            stored_at = datetime.utcnow()
+            batch = [{**document, "stored_at": stored_at} for document in documents[start:start + self.insert_batch_size]]
+            try:
+                collection.insert_many(batch, ordered=False)
+            except BulkWriteError as e:
+                details = e.details
+                if details.get("writeConcernErrors") or any(
+                    error["code"] != DUPLICATE_KEY for error in details.get("writeErrors", [])
+                ):
+                    raise
+        return len(documents)
+
+
+_spool = None
+_spool_lock = threading.Lock()
+
+
+def get_spool():
+    """
+    Return the process-wide chat spool, starting it on first use.
+    ChatEngine calls this at startup so existing spool files get replayed.
+    """
+    global _spool
+    with _spool_lock:
+        if _spool is None:
+            _spool = ChatSpool()
+        return _spool
@@ -0,0 +1,153 @@
+"""
+Size-budgeted encoding for generated images.
+
+Every image is written twice: a lossless original (optimized PNG) for
+download, and a display rendition (WebP by default, or AVIF / progressive
+JPEG) whose quality is searched per image to fit a byte budget.
+"""
+import io
+import os
+
+from PIL import Image
+
+DEFAULT_ENCODING_CONFIG = {
+    # WEBP, AVIF or JPEG; AVIF falls back to WEBP when Pillow lacks support
+    "display_format": "WEBP",
+    # Target size of the display rendition in bytes
+    "display_budget": 150 * 1024,
+    # Longest side of the display rendition in pixels
+    "max_dimension": 1024,
+    # Quality search range
+    "min_quality": 40,
+    "max_quality": 90,
+    # Scale factor applied when min_quality still exceeds the budget
+    "downscale_step": 0.75,
+    # PNG zlib level for the lossless original (0-9)
+    "png_compress_level": 9,
+}
+
+DISPLAY_EXTENSIONS = {"WEBP": ".webp", "AVIF": ".avif", "JPEG": ".jpg"}
+
+DISPLAY_MIME_TYPES = {"WEBP": "image/webp", "AVIF": "image/avif", "JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+def supported_display_format(display_format):
+    """
+    Return display_format if this Pillow build can write it, else WEBP
+    """
+    display_format = display_format.upper()
+    if display_format == "AVIF":
+        try:
+            # Pillow < 11.3 needs the pillow-avif-plugin package for AVIF
+            import pillow_avif  # noqa: F401
+        except ImportError:
+            pass
+        Image.init()
+        if "AVIF" not in Image.SAVE:
+            return "WEBP"
+    return display_format
+
+
+def display_path_for(output_path, display_format="WEBP"):
+    """
+    Path of the display rendition saved next to an original
+    """
+    root, _ = os.path.splitext(output_path)
+    return root + ".display" + DISPLAY_EXTENSIONS[supported_display_format(display_format)]
+
+
+def encode_original(image, config=None):
+    """
+    Encode the lossless original as an optimized PNG
+    """
+    config = {**DEFAULT_ENCODING_CONFIG, **(config or {})}
+    buffer = io.BytesIO()
+    image.save(buffer, format="PNG", optimize=True, compress_level=config["png_compress_level"])
+    return buffer.getvalue()
+
+
+def _encode(image, display_format, quality):
+    buffer = io.BytesIO()
+    if display_format == "JPEG":
+        if image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        image.save(buffer, format="JPEG", quality=quality, optimize=True, progressive=True)
+    elif display_format == "WEBP":
+        image.save(buffer, format="WEBP", quality=quality, method=6)
+    else:
+        image.save(buffer, format=display_format, quality=quality)
+    return buffer.getvalue()
+
+
+def encode_display(image, config=None):
+    """
+    Encode the display rendition at the highest quality that fits the budget.
+    Binary-searches quality between min_quality and max_quality; if even
+    min_quality is too large, the image is downscaled and searched again.
+
+    Returns a dict with the encoded bytes, format, quality and size.
+    """
+    config = {**DEFAULT_ENCODING_CONFIG, **(config or {})}
+    display_format = supported_display_format(config["display_format"])
+    budget = config["display_budget"]
+
+    image = image.copy()
+    image.thumbnail((config["max_dimension"], config["max_dimension"]))
+
+    while True:
+        low, high = config["min_quality"], config["max_quality"]
+        best = None
+        # Most images fit at max quality, which skips the search entirely
+        data = _encode(image, display_format, high)
+        if len(data) <= budget:
+            quality = high
+            break
+        high -= 1
+        while low <= high:
+            quality = (low + high) // 2
+            data = _encode(image, display_format, quality)
+            if len(data) <= budget:
+                best = (quality, data)
+                low = quality + 1
+            else:
+                high = quality - 1
+
+        if best is not None:
+            quality, data = best
+            break
+
+        width, height = image.size
+        new_size = (int(width * config["downscale_step"]), int(height * config["downscale_step"]))
+        if min(new_size) < 64:
+            # Give up on the budget rather than shrink the image to nothing
+            quality = config["min_quality"]
+            data = _encode(image, display_format, quality)
+            break
+        image = image.resize(new_size, Image.LANCZOS)
+
+    return {
+        "data": data,
+        "format": display_format,
+        "mime_type": DISPLAY_MIME_TYPES[display_format],
+        "quality": quality,
+        "size": image.size,
+        "bytes": len(data),
+    }
+
+
+def save_renditions(image, output_path, config=None):
+    """
+    Write the lossless original to output_path and the display rendition
+    next to it. Returns (output_path, display_path).
+    """
+    config = {**DEFAULT_ENCODING_CONFIG, **(config or {})}
+
+    with open(output_path, "wb") as f:
+        f.write(encode_original(image, config))
+
+    display = encode_display(image, config)
+    display_path = display_path_for(output_path, display["format"])
+    with open(display_path, "wb") as f:
+        f.write(display["data"])
+
+    return output_path, display_path
@@ -1,22 +1,52 @@
+import asyncio
 import base64
+import hashlib
+import json
 import os
 from google import genai
 from google.genai import types
 # Add these imports
 from PIL import Image
 import io
+from image_encoding import save_renditions
+
+MODEL_NAME = "gemini-2.0-flash-exp-image-generation"
+
+GENERATION_CONFIG = {
+    "temperature": 1,
+    "top_p": 0.95,
+    "top_k": 40,
+    "max_output_tokens": 8192,
+    "response_modalities": [
+        "image",
+        "text",
+    ],
+    "response_mime_type": "text/plain",
+}
+
+# Shared client so repeated generations reuse pooled HTTP connections
+_client = None
 
 def save_binary_file(file_name, data):
     f = open(file_name, "wb")
     f.write(data)
     f.close()
 
-def generate(prompt_text="An Indian Temple with a beautiful sunset", output_path="generated_image.png"):
-    client = genai.Client(
-        api_key=os.environ.get("GEMINI_API_KEY"),
-    )
+def get_client():
+    """
+    Return the process-wide genai client, creating it on first use
+    """
+    global _client
+    if _client is None:
+        _client = genai.Client(
+            api_key=os.environ.get("GEMINI_API_KEY"),
+        )
+    return _client
 
-    model = "gemini-2.0-flash-exp-image-generation"
+def build_request(prompt_text):
+    """
+    Build the contents and generation config for an image request
+    """
     contents = [
         types.Content(
             role="user",
@@ -25,70 +55,114 @@ def generate(prompt_text="An Indian Temple with a beautiful sunset", output_path
             ],
         ),
     ]
-    generate_content_config = types.GenerateContentConfig(
-        temperature=1,
-        top_p=0.95,
-        top_k=40,
-        max_output_tokens=8192,
-        response_modalities=[
-            "image",
-            "text",
-        ],
-        response_mime_type="text/plain",
-    )
+    generate_content_config = types.GenerateContentConfig(**GENERATION_CONFIG)
+    return contents, generate_content_config
+
+def request_key(prompt_text):
+    """
+    Key identifying an image request: the normalized prompt plus the model
+    and generation config, so identical requests can share one generation
+    """
+    normalized = " ".join(prompt_text.lower().split())
+    payload = json.dumps({"model": MODEL_NAME, "prompt": normalized, "config": GENERATION_CONFIG}, sort_keys=True)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+def save_image(image_data, output_path):
+    """
+    Decode inline image data and write it to output_path.
+    Returns output_path on success, None otherwise.
+    """
+    try:
+        # First, decode the base64 data if it's encoded that way
+        # Some APIs return raw binary data, others return base64-encoded data
+        try:
+            # Try to decode base64 data
+            decoded_data = base64.b64decode(image_data)
+        except:
+            # If not base64, use the original data
+            decoded_data = image_data
+        
+        # Create a PIL Image from binary data
+        image = Image.open(io.BytesIO(decoded_data))
+        
+        # Save the lossless original plus a size-budgeted display rendition
+        output_path, display_path = save_renditions(image, output_path)
+        print(f"Image saved to {output_path} (display: {display_path})")
+        
+        return output_path
+    except Exception as e:
+        print(f"Error saving image: {e}")
+        # Let's try an alternative approach by saving the raw data first
+        try:
+            with open("temp_raw_image", "wb") as f:
+                f.write(image_data)
+            print("Saved raw image data for debugging")
+            
+            # Try saving with the original save_binary_file function
+            save_binary_file(output_path, image_data)
+            print(f"Attempted to save using direct binary write to {output_path}")
+            return output_path
+        except Exception as e2:
+            print(f"Second attempt failed: {e2}")
+        return None
+
+def _inline_image(chunk):
+    """
+    Return the inline image payload of a streamed chunk, or None
+    """
+    return chunk.candidates[0].content.parts[0].inline_data
+
+def generate(prompt_text="An Indian Temple with a beautiful sunset", output_path="generated_image.png"):
+    client = get_client()
+
+    contents, generate_content_config = build_request(prompt_text)
 
     for chunk in client.models.generate_content_stream(
-        model=model,
+        model=MODEL_NAME,
         contents=contents,
         config=generate_content_config,
     ):
         if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
             continue
-        if chunk.candidates[0].content.parts[0].inline_data:
-            # Get image data
-            image_data = chunk.candidates[0].content.parts[0].inline_data.data
-            mime_type = chunk.candidates[0].content.parts[0].inline_data.mime_type
-            
-            # Decode and save the image
-            try:
-                # First, decode the base64 data if it's encoded that way
-                # Some APIs return raw binary data, others return base64-encoded data
-                try:
-                    # Try to decode base64 data
-                    decoded_data = base64.b64decode(image_data)
-                except:
-                    # If not base64, use the original data
-                    decoded_data = image_data
-                
-                # Create a PIL Image from binary data
-                image = Image.open(io.BytesIO(decoded_data))
-                
-                # Save the image
-                image.save(output_path)
-                print(f"Image saved to {output_path}")
-                
-                return output_path
-            except Exception as e:
-                print(f"Error saving image: {e}")
-                # Let's try an alternative approach by saving the raw data first
-                try:
-                    with open("temp_raw_image", "wb") as f:
-                        f.write(image_data)
-                    print("Saved raw image data for debugging")
-                    
-                    # Try saving with the original save_binary_file function
-                    save_binary_file(output_path, image_data)
-                    print(f"Attempted to save using direct binary write to {output_path}")
-                    return output_path
-                except Exception as e2:
-                    print(f"Second attempt failed: {e2}")
-                return None
+        inline_data = _inline_image(chunk)
+        if inline_data:
+            return save_image(inline_data.data, output_path)
         else:
             text_response = chunk.text
             print(text_response)
             
     return None
 
+async def generate_async(prompt_text="An Indian Temple with a beautiful sunset", output_path="generated_image.png", usage=None):
+    """
+    Async variant of generate() built on the SDK's aio client.
+    Decoding and writing the image runs in a worker thread so the
+    event loop stays free for other requests. If a usage dict is given,
+    it is filled with the prompt and output token counts.
+    """
+    client = get_client()
+
+    contents, generate_content_config = build_request(prompt_text)
+
+    stream = await client.aio.models.generate_content_stream(
+        model=MODEL_NAME,
+        contents=contents,
+        config=generate_content_config,
+    )
+    async for chunk in stream:
+        if usage is not None and chunk.usage_metadata:
+            usage["prompt_tokens"] = chunk.usage_metadata.prompt_token_count or 0
+            usage["output_tokens"] = chunk.usage_metadata.candidates_token_count or 0
+        if not chunk.candidates or not chunk.candidates[0].content or not chunk.candidates[0].content.parts:
+            continue
+        inline_data = _inline_image(chunk)
+        if inline_data:
+            return await asyncio.to_thread(save_image, inline_data.data, output_path)
+        else:
+            print(chunk.text)
+
+    return None
+
 if __name__ == "__main__":
     image_path = generate()
     if image_path:
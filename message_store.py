@@ -0,0 +1,216 @@
+"""
+Compact, bounded chat history for Streamlit session state.
+
+A MessageStore keeps roles as one-byte codes in an array and message text
+in a flat list, instead of one dict per message. Each session has a memory
+cap; when it is exceeded the oldest turns are spilled to MongoDB and can be
+paged back on demand. Spills run on a background thread, and messages
+leave memory only once MongoDB has them. System messages are never
+spilled, since they carry the conversation's instructions.
+"""
+import logging
+import sys
+import time
+import weakref
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+from mongo_utils import store_spilled_messages, load_spilled_messages
+
+ROLES = ("system", "user", "assistant")
+ROLE_CODES = {role: code for code, role in enumerate(ROLES)}
+
+# Per-session cap on message text kept in memory
+MAX_SESSION_BYTES = 512 * 1024
+# Spilling frees memory down to this fraction of the cap, so it runs in batches
+SPILL_LOW_WATER = 0.75
+# Seconds to wait after a failed spill before trying again; meanwhile the store stays over its cap
+SPILL_RETRY_INTERVAL = 30.0
+
+# Bookkeeping per message: list slot for the text, role code, sequence number
+_ENTRY_OVERHEAD = 8 + 1 + 8
+
+# Every live store in this process, for memory_report()
+_stores = weakref.WeakSet()
+
+# Spill writes for all sessions, kept off the Streamlit script thread
+_spill_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="message-spill")
+
+
+class MessageStore:
+    """
+    Append-only chat history with a memory cap.
+
+    Iterating, indexing and len() cover the messages held in memory, each
+    returned as a {"role", "content"} dict like the plain lists it replaces.
+    page() reads any range of the full history, loading spilled messages
+    from MongoDB.
+    """
+
+    def __init__(self, session_id, max_bytes=MAX_SESSION_BYTES, spill=store_spilled_messages, load=load_spilled_messages):
+        self.session_id = session_id
+        self.max_bytes = max_bytes
+        self._spill = spill
+        self._load = load
+        self._roles = array("B")
+        self._seqs = array("Q")
+        self._contents = []
+        self._next_seq = 0
+        # Sequence number of the first message since the last clear()
+        self._base_seq = 0
+        self._spilled = 0
+        self._bytes = 0
+        self._spill_retry_at = 0.0
+        # (future, seqs) of the spill in progress, if any
+        self._spilling = None
+        _stores.add(self)
+
+    def append(self, message):
+        self.add(message["role"], message["content"])
+
+    def add(self, role, content):
+        if role not in ROLE_CODES:
+            raise ValueError(f"Unknown message role: {role}")
+        self._roles.append(ROLE_CODES[role])
+        self._seqs.append(self._next_seq)
+        self._contents.append(content)
+        self._next_seq += 1
+        self._bytes += sys.getsizeof(content) + _ENTRY_OVERHEAD
+        if self._spilling is not None:
+            self._finish_spill()
+        if self._bytes > self.max_bytes and self._spilling is None and time.monotonic() >= self._spill_retry_at:
+            self._spill_oldest()
+
+    def clear(self):
+        # Sequence numbers keep counting so spilled rows from before the clear never collide
+        self._base_seq = self._next_seq
+        self._spilled = 0
+        self._roles = array("B")
+        self._seqs = array("Q")
+        self._contents = []
+        self._bytes = 0
+
+    def __len__(self):
+        return len(self._contents)
+
+    def __iter__(self):
+        for code, content in zip(self._roles, self._contents):
+            yield {"role": ROLES[code], "content": content}
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return [self[i] for i in range(*index.indices(len(self)))]
+        return {"role": ROLES[self._roles[index]], "content": self._contents[index]}
+
+    @property
+    def spilled_count(self):
+        """Number of messages paged out to MongoDB"""
+        return self._spilled
+
+    @property
+    def total_count(self):
+        """Number of messages in the whole conversation"""
+        return self._next_seq - self._base_seq
+
+    def memory_bytes(self):
+        """Approximate memory held by the messages in this store"""
+        return self._bytes
+
+    def page(self, start=0, end=None):
+        """
+        Return messages start..end (exclusive) of the full conversation,
+        loading any spilled ones from MongoDB.
+        """
+        if self._spilling is not None:
+            self._finish_spill()
+        start = self._base_seq + start
+        end = self._next_seq if end is None else min(self._base_seq + end, self._next_seq)
+        in_memory = {
+            seq: {"role": ROLES[code], "content": content}
+            for seq, code, content in zip(self._seqs, self._roles, self._contents)
+            if start <= seq < end
+        }
+        if len(in_memory) < end - start:
+            try:
+                for message in self._load(self.session_id, start, end):
+                    in_memory.setdefault(message["seq"], {"role": message["role"], "content": message["content"]})
+            except Exception as e:
+                logging.error(f"Error loading spilled messages: {e}")
+        return [in_memory[seq] for seq in sorted(in_memory)]
+
+    def _spill_oldest(self):
+        target = self.max_bytes * SPILL_LOW_WATER
+        freed = 0
+        spill_indexes = []
+        for i, code in enumerate(self._roles):
+            if self._bytes - freed <= target or i == len(self._roles) - 1:
+                break
+            if code == ROLE_CODES["system"]:
+                continue
+            spill_indexes.append(i)
+            freed += sys.getsizeof(self._contents[i]) + _ENTRY_OVERHEAD
+        if not spill_indexes:
+            return
+
+        spilled = [
+            {"seq": self._seqs[i], "role": ROLES[self._roles[i]], "content": self._contents[i]}
+            for i in spill_indexes
+        ]
+        future = _spill_executor.submit(self._spill, self.session_id, spilled)
+        self._spilling = (future, {message["seq"] for message in spilled})
+
+    def _finish_spill(self):
+        # Messages leave memory only once MongoDB has acknowledged them
+        future, seqs = self._spilling
+        if not future.done():
+            return
+        self._spilling = None
+        try:
+            stored = future.result()
+        except Exception as e:
+            logging.error(f"Error spilling messages of session {self.session_id}: {e}")
+            stored = False
+        if not stored:
+            # Keep them in memory over the cap rather than lose them; retry later
+            logging.warning(f"Keeping {len(seqs)} messages of session {self.session_id} in memory: spill failed")
+            self._spill_retry_at = time.monotonic() + SPILL_RETRY_INTERVAL
+            return
+
+        # Messages cleared while the spill ran are already gone
+        keep = [i for i, seq in enumerate(self._seqs) if seq not in seqs]
+        if len(keep) == len(self._seqs):
+            return
+        freed = sum(
+            sys.getsizeof(content) + _ENTRY_OVERHEAD
+            for seq, content in zip(self._seqs, self._contents)
+            if seq in seqs
+        )
+        self._spilled += len(self._seqs) - len(keep)
+        self._roles = array("B", (self._roles[i] for i in keep))
+        self._seqs = array("Q", (self._seqs[i] for i in keep))
+        self._contents = [self._contents[i] for i in keep]
+        self._bytes -= freed
+
+
+def memory_report():
+    """
+    Summarise in-memory chat history across all sessions in this process,
+    for capacity planning. Returns totals plus one row per session.
+    """
+    sessions = [
+        {
+            "session_id": store.session_id,
+            "messages_in_memory": len(store),
+            "messages_spilled": store.spilled_count,
+            "bytes": store.memory_bytes(),
+        }
+        for store in list(_stores)
+    ]
+    total_bytes = sum(row["bytes"] for row in sessions)
+    return {
+        "sessions": len(sessions),
+        "total_bytes": total_bytes,
+        "mean_bytes": total_bytes / len(sessions) if sessions else 0,
+        "max_bytes": max((row["bytes"] for row in sessions), default=0),
+        "per_session": sorted(sessions, key=lambda row: row["bytes"], reverse=True),
+    }
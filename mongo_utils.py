@@ -1,12 +1,64 @@
 import os
+import threading
 import yaml
-from pymongo import MongoClient
+from pymongo import MongoClient, AsyncMongoClient, ASCENDING, ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError
+from bson import ObjectId
 from dotenv import load_dotenv
-from datetime import datetime
+from datetime import datetime, timedelta
 
 # Load environment variables from .env file
 load_dotenv()
 
+# MongoDB duplicate key error code; the document is already stored
+DUPLICATE_KEY = 11000
+
+# Older session messages paged out of memory by message_store.MessageStore
+SPILL_COLLECTION = 'session_messages'
+
+# Per-call token and image usage written by usage_ledger.UsageLedger
+USAGE_COLLECTION = 'usage_ledger'
+
+# Usage rollups maintained from chatrecords by update_usage_rollups()
+ROLLUP_STATE_COLLECTION = 'rollup_state'
+SESSION_ROLLUP_COLLECTION = 'usage_by_session'
+DAILY_ROLLUP_COLLECTION = 'usage_by_day'
+MODEL_ROLLUP_COLLECTION = 'usage_by_model'
+
+# Records stored more recently than this are left for the next run, since
+# stored_at is set by the writer just before the insert and may land
+# slightly out of order
+ROLLUP_LAG = timedelta(seconds=30)
+# How long one updater may hold the rollup lock before others may take over
+ROLLUP_LEASE = timedelta(minutes=10)
+
+# Grouping key of each rollup collection
+ROLLUP_GROUPS = {
+    SESSION_ROLLUP_COLLECTION: '$session_id',
+    DAILY_ROLLUP_COLLECTION: {
+        'day': {'$dateToString': {'format': '%Y-%m-%d', 'date': '$timestamp'}},
+        'model': '$model',
+        'platform': '$platform'
+    },
+    MODEL_ROLLUP_COLLECTION: '$model',
+}
+
+# Additive counters kept by every rollup
+ROLLUP_COUNTERS = {
+    'messages': {'$sum': 1},
+    'user_chars': {'$sum': {'$strLenCP': {'$toString': {'$ifNull': ['$user_message', '']}}}},
+    'bot_chars': {'$sum': {'$strLenCP': {'$toString': {'$ifNull': ['$bot_response', '']}}}},
+}
+
+# Fail fast when the server is unreachable instead of pymongo's 30 s default
+SERVER_SELECTION_TIMEOUT_MS = 3000
+
+# Synchronous clients shared per (URI, timeout); each one pools its connections
+_clients = {}
+_clients_lock = threading.Lock()
+# The spill collection's unique index is created by the first spill in the process
+_spill_index_ready = False
+
 def get_mongodb_uri():
     """
     Get MongoDB URI from environment variables or app.yaml
@@ -30,28 +82,54 @@ def get_mongodb_uri():
     
     return mongodb_uri
 
-def get_db_connection():
+def get_database_name():
     """
-    Connect to MongoDB and return the database and collection
+    Get the database name, overridable with MONGODB_DB (e.g. for load tests)
+    """
+    return os.environ.get('MONGODB_DB') or 'streamlitchat'
+
+def get_db_connection(timeout_ms=SERVER_SELECTION_TIMEOUT_MS):
+    """
+    Connect to MongoDB and return the database and collection.
+    timeout_ms bounds server selection, so callers can fail fast when the server is down.
+    The client is shared by every caller in the process, so don't close it.
     """
     mongodb_uri = get_mongodb_uri()
     if not mongodb_uri:
         return None, None
     
-    client = MongoClient(mongodb_uri)
-    db = client['streamlitchat']
+    with _clients_lock:
+        client = _clients.get((mongodb_uri, timeout_ms))
+        if client is None:
+            client_options = {}
+            if timeout_ms is not None:
+                client_options['serverSelectionTimeoutMS'] = timeout_ms
+            client = _clients[(mongodb_uri, timeout_ms)] = MongoClient(mongodb_uri, **client_options)
+    db = client[get_database_name()]
     collection = db['chatrecords']
     return db, collection
 
-def store_chat_message(session_id, user_message, bot_response, platform="unknown", ip_address="unknown", model="gemini-1.5-pro"):
+def get_async_db_connection():
     """
-    Store a chat message in MongoDB
+    Connect to MongoDB with the asyncio driver and return the database and collection.
+    The client binds to the running event loop, so call this from inside it.
     """
-    _, collection = get_db_connection()
-    if collection is None:  # Correct way to check
-        return False
-        
-    chat_document = {
+    mongodb_uri = get_mongodb_uri()
+    if not mongodb_uri:
+        return None, None
+    
+    client = AsyncMongoClient(mongodb_uri)
+    db = client[get_database_name()]
+    collection = db['chatrecords']
+    return db, collection
+
+def build_chat_document(session_id, user_message, bot_response, platform="unknown", ip_address="unknown", model="gemini-1.5-pro"):
+    """
+    Build the chatrecords document for one user/bot exchange.
+    The _id is assigned up front so retried inserts are idempotent.
+    """
+    return {
+        '_id': ObjectId(),
         'session_id': session_id,
         'timestamp': datetime.utcnow(),
         'user_message': user_message,
@@ -60,8 +138,40 @@ def store_chat_message(session_id, user_message, bot_response, platform="unknown
         'ip_address': ip_address,
         'model': model
     }
+
+def store_chat_message(session_id, user_message, bot_response, platform="unknown", ip_address="unknown", model="gemini-1.5-pro"):
+    """
+    Store a chat message in MongoDB
+    """
+    _, collection = get_db_connection()
+    if collection is None:  # Correct way to check
+        return False
+        
+    chat_document = build_chat_document(session_id, user_message, bot_response, platform, ip_address, model)
     
-    collection.insert_one(chat_document)
+    collection.insert_one({**chat_document, 'stored_at': datetime.utcnow()})
+    return True
+
+async def store_chat_message_async(collection, session_id, user_message, bot_response, platform="unknown", ip_address="unknown", model="gemini-1.5-pro"):
+    """
+    Store a chat message using an AsyncMongoClient collection
+    """
+    if collection is None:
+        return False
+    
+    chat_document = build_chat_document(session_id, user_message, bot_response, platform, ip_address, model)
+    
+    return await store_chat_document_async(collection, chat_document)
+
+async def store_chat_document_async(collection, chat_document):
+    """
+    Store a document built by build_chat_document using an AsyncMongoClient collection.
+    stored_at records when it was written, which the rollups follow.
+    """
+    if collection is None:
+        return False
+    
+    await collection.insert_one({**chat_document, 'stored_at': datetime.utcnow()})
     return True
 
 def get_chat_history_by_session(session_id):
@@ -78,3 +188,289 @@ def get_chat_history_by_session(session_id):
     ).sort('timestamp', 1))
     
     return history
+
+async def store_usage_entries_async(db, entries):
+    """
+    Store a batch of usage ledger entries using an AsyncMongoClient database.
+    Entries carry their _id, so any already stored by an earlier attempt are
+    skipped as duplicates. Returns the entries that still need storing.
+    """
+    if db is None:
+        return entries
+    if not entries:
+        return []
+    
+    try:
+        await db[USAGE_COLLECTION].insert_many(entries, ordered=False)
+    except BulkWriteError as e:
+        details = e.details
+        if details.get('writeConcernErrors'):
+            return entries
+        failed = {error['index'] for error in details.get('writeErrors', []) if error['code'] != DUPLICATE_KEY}
+        return [entry for index, entry in enumerate(entries) if index in failed]
+    return []
+
+async def load_usage_totals_async(db, session_id, day_start):
+    """
+    Sum a session's usage ledger, all time and since day_start.
+    Returns (totals, today) counter dicts.
+    """
+    counters = {
+        'prompt_tokens': {'$sum': '$prompt_tokens'},
+        'output_tokens': {'$sum': '$output_tokens'},
+        'images': {'$sum': '$images'}
+    }
+    pipeline = [
+        {'$match': {'session_id': session_id}},
+        {'$facet': {
+            'totals': [{'$group': {'_id': None, **counters}}],
+            'today': [{'$match': {'timestamp': {'$gte': day_start}}}, {'$group': {'_id': None, **counters}}]
+        }}
+    ]
+    cursor = await db[USAGE_COLLECTION].aggregate(pipeline)
+    result = (await cursor.to_list(length=1))[0]
+    
+    def strip(docs):
+        if not docs:
+            return None
+        return {field: docs[0][field] for field in counters}
+    return strip(result['totals']), strip(result['today'])
+
+def iter_chat_records(start=None, end=None):
+    """
+    Iterate chat records in timestamp order, optionally within [start, end)
+    """
+    _, collection = get_db_connection()
+    if collection is None:
+        return iter(())
+    
+    query = {}
+    if start or end:
+        query['timestamp'] = {}
+        if start:
+            query['timestamp']['$gte'] = start
+        if end:
+            query['timestamp']['$lt'] = end
+    
+    return collection.find(
+        query,
+        {'_id': 0, 'session_id': 1, 'timestamp': 1, 'user_message': 1, 'bot_response': 1, 'model': 1}
+    ).sort('timestamp', 1).batch_size(1000)
+
+def store_spilled_messages(session_id, messages):
+    """
+    Store messages evicted from a session's in-memory history.
+    Each message is a dict with 'seq', 'role' and 'content'.
+    """
+    global _spill_index_ready
+    db, collection = get_db_connection()
+    if collection is None or not messages:
+        return False
+    
+    spill_collection = db[SPILL_COLLECTION]
+    if not _spill_index_ready:
+        spill_collection.create_index([('session_id', ASCENDING), ('seq', ASCENDING)], unique=True)
+        _spill_index_ready = True
+    try:
+        spill_collection.insert_many(
+            [{'session_id': session_id, **message} for message in messages],
+            ordered=False
+        )
+    except BulkWriteError as e:
+        # Messages stored by an earlier attempt that timed out are duplicates, not failures
+        details = e.details
+        if details.get('writeConcernErrors') or any(
+            error['code'] != DUPLICATE_KEY for error in details.get('writeErrors', [])
+        ):
+            raise
+    return True
+
+def load_spilled_messages(session_id, start_seq=0, end_seq=None):
+    """
+    Load spilled messages for a session with start_seq <= seq < end_seq
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return []
+    
+    seq_range = {'$gte': start_seq}
+    if end_seq is not None:
+        seq_range['$lt'] = end_seq
+    
+    return list(db[SPILL_COLLECTION].find(
+        {'session_id': session_id, 'seq': seq_range},
+        {'_id': 0, 'seq': 1, 'role': 1, 'content': 1}
+    ).sort('seq', 1))
+
+def ensure_rollup_indexes():
+    """
+    Create the indexes the rollup updater, usage ledger and query helpers rely on
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return False
+    
+    collection.create_index([('timestamp', ASCENDING)])
+    collection.create_index([('stored_at', ASCENDING)])
+    db[DAILY_ROLLUP_COLLECTION].create_index([('_id.day', ASCENDING)])
+    db[USAGE_COLLECTION].create_index([('session_id', ASCENDING), ('timestamp', ASCENDING)])
+    return True
+
+def _rollup_pipeline(target, group_id, start, end):
+    """
+    Aggregate chatrecords stored in (start, end] and $merge the counts into target.
+    Each rollup document remembers the last window folded into it, so
+    re-running a window that was already merged leaves it unchanged.
+    """
+    time_range = {'$lte': end}
+    if start is not None:
+        time_range['$gt'] = start
+    # Windows follow stored_at, so records replayed from the spool after an
+    # outage are still counted; records from before stored_at existed fall
+    # back to their timestamp
+    in_window = {'$or': [
+        {'stored_at': time_range},
+        {'stored_at': {'$exists': False}, 'timestamp': time_range}
+    ]}
+    
+    # Documents written by this window already have last_window == end
+    is_new_window = {'$lt': [{'$ifNull': ['$last_window', None]}, '$$new.last_window']}
+    merged_counters = {
+        field: {'$cond': [is_new_window, {'$add': [f'${field}', f'$$new.{field}']}, f'${field}']}
+        for field in ROLLUP_COUNTERS
+    }
+    return [
+        {'$match': in_window},
+        {'$group': {
+            '_id': group_id,
+            **ROLLUP_COUNTERS,
+            'first_seen': {'$min': '$timestamp'},
+            'last_seen': {'$max': '$timestamp'}
+        }},
+        {'$set': {'last_window': end}},
+        {'$merge': {
+            'into': target,
+            'on': '_id',
+            'whenMatched': [{'$set': {
+                **merged_counters,
+                'first_seen': {'$min': ['$first_seen', '$$new.first_seen']},
+                'last_seen': {'$max': ['$last_seen', '$$new.last_seen']},
+                'last_window': {'$max': ['$last_window', '$$new.last_window']}
+            }}],
+            'whenNotMatched': 'insert'
+        }}
+    ]
+
+def update_usage_rollups(now=None):
+    """
+    Fold chatrecords written since the last run into the rollup collections.
+    Each rollup keeps its own stored_at watermark. The window is recorded in
+    rollup_state before it is merged, so after a crash the next run repeats
+    exactly that window, which the merge skips for documents it already
+    updated. Returns the new watermark, or None if MongoDB is unavailable
+    or another updater holds the lock.
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return None
+    
+    now = now or datetime.utcnow()
+    state_collection = db[ROLLUP_STATE_COLLECTION]
+    
+    # Take a lease so concurrent updaters never merge the same window twice
+    try:
+        state = state_collection.find_one_and_update(
+            {
+                '_id': 'chatrecords',
+                '$or': [{'locked_until': {'$lt': now}}, {'locked_until': None}]
+            },
+            {'$set': {'locked_until': now + ROLLUP_LEASE}},
+            upsert=True,
+            return_document=ReturnDocument.AFTER
+        )
+    except DuplicateKeyError:
+        return None
+    
+    watermarks = state.get('watermarks', {})
+    pending = state.get('pending', {})
+    end = now - ROLLUP_LAG
+    try:
+        for target, group_id in ROLLUP_GROUPS.items():
+            window = pending.get(target)
+            if window is None:
+                start = watermarks.get(target)
+                if start is not None and start >= end:
+                    continue
+                window = {'start': start, 'end': end}
+                state_collection.update_one(
+                    {'_id': 'chatrecords'},
+                    {'$set': {f'pending.{target}': window}}
+                )
+            collection.aggregate(_rollup_pipeline(target, group_id, window['start'], window['end']))
+            state_collection.update_one(
+                {'_id': 'chatrecords'},
+                {
+                    '$set': {f'watermarks.{target}': window['end']},
+                    '$unset': {f'pending.{target}': ''}
+                }
+            )
+    finally:
+        state_collection.update_one({'_id': 'chatrecords'}, {'$set': {'locked_until': None}})
+    
+    return end
+
+def get_session_usage(session_id):
+    """
+    Get message counts and response sizes for one session from the rollups
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return None
+    
+    return db[SESSION_ROLLUP_COLLECTION].find_one({'_id': session_id})
+
+def get_daily_usage(start_day=None, end_day=None, model=None, platform=None):
+    """
+    Get per-day usage from the rollups, optionally filtered.
+    Days are 'YYYY-MM-DD' strings in UTC, both bounds inclusive.
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return []
+    
+    query = {}
+    if start_day or end_day:
+        query['_id.day'] = {}
+        if start_day:
+            query['_id.day']['$gte'] = start_day
+        if end_day:
+            query['_id.day']['$lte'] = end_day
+    if model:
+        query['_id.model'] = model
+    if platform:
+        query['_id.platform'] = platform
+    
+    usage = []
+    for doc in db[DAILY_ROLLUP_COLLECTION].find(query).sort('_id.day', 1):
+        key = doc.pop('_id')
+        usage.append({**key, **doc})
+    return usage
+
+def get_model_usage():
+    """
+    Get all-time usage per model from the rollups
+    """
+    db, collection = get_db_connection()
+    if collection is None:
+        return []
+    
+    return [
+        {'model': doc.pop('_id'), **doc}
+        for doc in db[MODEL_ROLLUP_COLLECTION].find().sort('messages', -1)
+    ]
+
+if __name__ == "__main__":
+    # Run periodically (e.g. from cron) to keep the usage rollups current
+    ensure_rollup_indexes()
+    watermark = update_usage_rollups()
+    print(f"Usage rollups updated to {watermark}")
@@ -0,0 +1,288 @@
+"""
+Replay production traffic from chatrecords for realistic load testing.
+
+Builds a trace from stored chat records (session ids, timestamps and the
+sizes of user messages and bot responses), then replays every session with
+its recorded pacing against ChatEngine, the same chat path the Streamlit UI
+and the HTTP API use. Gemini is replaced by a local fake model whose
+replies are sized like the recorded bot_response, and image generation by
+a fake generator that writes a placeholder image through the real
+rendition pipeline, so runs cost nothing and measure our own overhead.
+Message text is never copied into the trace; image prompts are kept only
+as a hash, so repeated prompts still coalesce.
+
+Usage:
+    python replay_trace.py --since 2026-10-01 --until 2026-10-02 --speed 10
+    python replay_trace.py --since 2026-10-01 --save-trace trace.json
+    python replay_trace.py --trace trace.json --speed 60 --sessions 500
+    python replay_trace.py --trace trace.json --persist --db streamlitchat_loadtest
+"""
+import argparse
+import asyncio
+import json
+import os
+import statistics
+import tempfile
+from collections import deque
+from datetime import datetime
+from uuid import uuid4
+
+from PIL import Image
+
+from chat_engine import ChatEngine, IMAGE_CACHE_TTL
+from image_encoding import save_renditions
+from imagen import request_key
+from mongo_utils import iter_chat_records
+
+IMAGE_PREFIXES = ("generate image:", "create image:")
+
+
+def load_trace(start=None, end=None, max_sessions=None):
+    """
+    Build a trace from chatrecords. Each session lists its turns with the
+    offset in seconds from the first record of the trace and the sizes of
+    the user message and bot response.
+    """
+    sessions = {}
+    trace_start = None
+    for record in iter_chat_records(start, end):
+        timestamp = record["timestamp"]
+        if trace_start is None:
+            trace_start = timestamp
+        session_id = record["session_id"]
+        if session_id not in sessions:
+            if max_sessions and len(sessions) >= max_sessions:
+                continue
+            sessions[session_id] = []
+        user_message = record.get("user_message") or ""
+        turn = {
+            "offset": (timestamp - trace_start).total_seconds(),
+            "user_chars": len(user_message),
+            "bot_chars": len(record.get("bot_response") or ""),
+            "image": user_message.lower().startswith(IMAGE_PREFIXES),
+        }
+        if turn["image"]:
+            turn["prompt_key"] = request_key(user_message.split(":", 1)[1])[:16]
+        sessions[session_id].append(turn)
+    return [{"session_id": session_id, "turns": turns} for session_id, turns in sessions.items()]
+
+
+class FakeModel:
+    """
+    Latency model for fake replies: time to first token plus streaming time
+    """
+
+    def __init__(self, ttft=0.5, chars_per_second=400.0, image_latency=8.0):
+        self.ttft = ttft
+        self.chars_per_second = chars_per_second
+        self.image_latency = image_latency
+
+    def latency(self, chars):
+        return self.ttft + chars / self.chars_per_second
+
+
+class FakeResponse:
+    def __init__(self, text):
+        self.text = text
+
+
+class FakeChat:
+    """
+    Stands in for a Gemini ChatSession, replying with text sized like the
+    recorded bot responses of one session, in order
+    """
+
+    def __init__(self, model, response_sizes):
+        self.model = model
+        self._sizes = deque(response_sizes)
+
+    async def send_message_async(self, message, stream=False):
+        size = self._sizes.popleft() if self._sizes else len(message)
+        await asyncio.sleep(self.model.latency(size))
+        return FakeResponse("x" * size)
+
+
+class FakeImageGenerator:
+    """
+    Stands in for imagen.generate_async: waits image_latency seconds, then
+    saves a placeholder image with the same renditions as a real one
+    """
+
+    def __init__(self, model, size=512):
+        self.model = model
+        self.size = size
+
+    async def __call__(self, prompt_text, output_path, usage=None):
+        await asyncio.sleep(self.model.image_latency)
+        image = Image.new("RGB", (self.size, self.size), (len(prompt_text) * 37 % 256, 96, 160))
+        await asyncio.to_thread(save_renditions, image, output_path)
+        return output_path
+
+
+async def replay_session(engine, model, session, speed, t0, results):
+    loop = asyncio.get_running_loop()
+    turns = session["turns"]
+    chat = FakeChat(model, [turn["bot_chars"] for turn in turns if not turn["image"]])
+    session_id = f"replay-{session['session_id']}"
+
+    for turn in turns:
+        expected = model.image_latency if turn["image"] else model.latency(turn["bot_chars"])
+        # Records are stamped when the reply is stored, so the user sent the
+        # message roughly one model latency earlier
+        arrival = max(0.0, turn["offset"] - expected)
+        scheduled = t0 + arrival / speed
+        # A user can't send the next message before the previous reply arrived
+        delay = scheduled - loop.time()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        started = loop.time()
+        error = None
+        try:
+            if turn["image"]:
+                # Turns from traces saved before prompt keys were recorded never coalesce
+                prompt = f"replay {turn.get('prompt_key') or uuid4().hex}"
+                output_path = os.path.join(engine.image_dir, f"replay_{uuid4().hex}.png")
+                await engine.image_job(
+                    prompt,
+                    output_path,
+                    session_id,
+                    user_message=f"generate image: {prompt}",
+                    bot_response="x" * turn["bot_chars"]
+                )
+            else:
+                await engine.chat_turn(chat, session_id, "x" * max(turn["user_chars"], 1))
+        except Exception as e:
+            error = str(e)
+        latency = loop.time() - started
+        results.append({
+            "kind": "image" if turn["image"] else "chat",
+            "latency": latency,
+            "overhead": latency - expected,
+            "lag": started - scheduled,
+            "error": error,
+        })
+
+
+async def replay(engine, trace, model, speed=1.0):
+    """
+    Replay all sessions of a trace concurrently. Returns per-turn results
+    and the wall-clock duration of the run.
+    """
+    loop = asyncio.get_running_loop()
+    results = []
+    t0 = loop.time() + 0.1
+    await asyncio.gather(*(replay_session(engine, model, session, speed, t0, results) for session in trace))
+    return results, loop.time() - t0
+
+
+def _percentiles(values):
+    if not values:
+        return {}
+    if len(values) == 1:
+        return {"p50": values[0], "p90": values[0], "p99": values[0], "max": values[0]}
+    cuts = statistics.quantiles(values, n=100, method="inclusive")
+    return {"p50": cuts[49], "p90": cuts[89], "p99": cuts[98], "max": max(values)}
+
+
+def summarize(results, elapsed):
+    """
+    Latency, engine overhead, schedule lag and throughput of a replay run
+    """
+    chat = [r for r in results if r["kind"] == "chat" and r["error"] is None]
+    images = [r for r in results if r["kind"] == "image" and r["error"] is None]
+    return {
+        "turns": len(results),
+        "chat_turns": len(chat),
+        "image_turns": len(images),
+        "errors": sum(1 for r in results if r["error"] is not None),
+        "elapsed_seconds": elapsed,
+        "throughput_turns_per_second": len(results) / elapsed if elapsed > 0 else 0,
+        "chat_latency": _percentiles([r["latency"] for r in chat]),
+        "chat_overhead": _percentiles([r["overhead"] for r in chat]),
+        "image_latency": _percentiles([r["latency"] for r in images]),
+        "schedule_lag": _percentiles([r["lag"] for r in results]),
+    }
+
+
+def print_report(summary):
+    print(f"Turns: {summary['turns']} ({summary['chat_turns']} chat ok, {summary['image_turns']} image ok, {summary['errors']} errors)")
+    print(f"Elapsed: {summary['elapsed_seconds']:.1f} s, throughput: {summary['throughput_turns_per_second']:.2f} turns/s")
+    if summary.get("image_stats"):
+        stats = summary["image_stats"]
+        print(f"Images: {stats['upstream_calls']} generated, {stats['saved']} served by coalescing or the cache")
+    for label, key in [("Chat latency", "chat_latency"), ("Engine overhead", "chat_overhead"),
+                       ("Image latency", "image_latency"), ("Schedule lag", "schedule_lag")]:
+        stats = summary[key]
+        if stats:
+            print(f"{label:<16} " + "  ".join(f"{name} {value * 1000:8.1f} ms" for name, value in stats.items()))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay chatrecords traffic against the chat engine with a fake model")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="Start of the trace window (UTC, ISO format)")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="End of the trace window (UTC, ISO format)")
+    parser.add_argument("--sessions", type=int, help="Replay at most this many sessions")
+    parser.add_argument("--trace", help="Replay a trace saved with --save-trace instead of reading MongoDB")
+    parser.add_argument("--save-trace", help="Write the trace to this JSON file and exit")
+    parser.add_argument("--speed", type=float, default=1.0, help="Time compression factor (1 = real time)")
+    parser.add_argument("--ttft", type=float, default=0.5, help="Fake model time to first token, seconds")
+    parser.add_argument("--chars-per-second", type=float, default=400.0, help="Fake model streaming rate")
+    parser.add_argument("--image-latency", type=float, default=8.0, help="Fake image generation time, seconds")
+    parser.add_argument("--persist", action="store_true", help="Also write replayed turns to MongoDB; requires --db or --mongodb-uri")
+    parser.add_argument("--db", help="Database for --persist writes, instead of the production database")
+    parser.add_argument("--mongodb-uri", help="MongoDB server for --persist writes, instead of MONGODB_URI")
+    parser.add_argument("--image-cache", action="store_true", help="Also serve repeated image prompts from the shared cache (CACHE_URL)")
+    parser.add_argument("--json", action="store_true", help="Print the summary as JSON")
+    args = parser.parse_args()
+    if args.persist and not (args.db or args.mongodb_uri):
+        parser.error("--persist needs --db or --mongodb-uri, so replayed turns never land in production chatrecords")
+
+    if args.trace:
+        with open(args.trace) as f:
+            trace = json.load(f)[:args.sessions]
+    else:
+        trace = load_trace(args.since, args.until, args.sessions)
+
+    if args.save_trace:
+        with open(args.save_trace, "w") as f:
+            json.dump(trace, f)
+        print(f"Saved {len(trace)} sessions to {args.save_trace}")
+        return
+
+    if not trace:
+        print("No chat records found for the selected window.")
+        return
+
+    with tempfile.TemporaryDirectory(prefix="replay-") as work_dir:
+        if args.persist:
+            # Set after the trace is read, so only the replayed writes go to the test database
+            if args.mongodb_uri:
+                os.environ["MONGODB_URI"] = args.mongodb_uri
+            if args.db:
+                os.environ["MONGODB_DB"] = args.db
+            # Keep records that fail over to the spool away from the production spool
+            os.environ["CHAT_SPOOL_DIR"] = os.path.join(work_dir, "spool")
+
+        model = FakeModel(args.ttft, args.chars_per_second, args.image_latency)
+        engine = ChatEngine(
+            platform="replay",
+            ip_address="replay",
+            persist=args.persist,
+            image_cache_ttl=IMAGE_CACHE_TTL if args.image_cache else 0,
+            image_dir=work_dir,
+            image_generator=FakeImageGenerator(model)
+        )
+        results, elapsed = engine.run(replay(engine, trace, model, args.speed))
+        engine.shutdown()
+
+    summary = summarize(results, elapsed)
+    summary["image_stats"] = engine.image_stats()
+    if args.json:
+        print(json.dumps(summary, indent=2))
+    else:
+        print_report(summary)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,384 @@
+"""
+Cross-process cache shared by all Streamlit workers.
+
+st.cache_data and st.cache_resource live inside one process, so workers
+behind a load balancer each redo the same work. The backends here store
+pickled values in a local SQLite file (shared by every worker on the host)
+or in Redis / any Redis-compatible server, with TTLs, size-bounded LRU
+eviction and an atomic get-or-compute that lets one worker compute a
+missing value while the others wait for it.
+
+The backend is selected with CACHE_URL:
+- sqlite:///path/to/cache.db   (default: sqlite:///.cache/streamlit_chat.db)
+- redis://host:6379/0          (requires the optional `redis` package)
+"""
+import functools
+import hashlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from uuid import uuid4
+
+import yaml
+
+DEFAULT_CACHE_URL = "sqlite:///.cache/streamlit_chat.db"
+
+_MISSING = object()
+
+
+def get_cache_url():
+    """
+    Get the cache URL from environment variables or app.yaml
+    """
+    cache_url = os.environ.get('CACHE_URL')
+
+    if not cache_url:
+        try:
+            with open('app.yaml', 'r') as yaml_file:
+                config = yaml.safe_load(yaml_file)
+                env_vars = config.get('env_variables', {})
+                cache_url = env_vars.get('CACHE_URL')
+        except Exception:
+            pass
+
+    return cache_url or DEFAULT_CACHE_URL
+
+
+class CacheBackend:
+    """
+    Base class for shared caches. Subclasses implement the storage and
+    locking primitives; get_or_compute is built on top of them.
+    """
+
+    def __init__(self, default_ttl=None, lock_timeout=60, poll_interval=0.1):
+        self.default_ttl = default_ttl
+        self.lock_timeout = lock_timeout
+        self.poll_interval = poll_interval
+
+    def get(self, key, default=None):
+        raise NotImplementedError
+
+    def set(self, key, value, ttl=None):
+        raise NotImplementedError
+
+    def delete(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        raise NotImplementedError
+
+    def _acquire(self, key, owner, lease):
+        raise NotImplementedError
+
+    def _release(self, key, owner):
+        raise NotImplementedError
+
+    def get_or_compute(self, key, compute, ttl=None, cache_if=None):
+        """
+        Return the cached value for key, computing and storing it if missing.
+        Only one caller across all processes runs compute for a given key;
+        the others wait for its result. If the lock holder takes longer than
+        lock_timeout, waiters give up and compute the value themselves.
+        A computed value is only stored if cache_if(value) is true, so
+        failure results (e.g. None) can be retried by the next caller.
+        """
+        value = self.get(key, _MISSING)
+        if value is not _MISSING:
+            return value
+
+        owner = uuid4().hex
+        deadline = time.monotonic() + self.lock_timeout
+        acquired = False
+        while not acquired:
+            acquired = self._acquire(key, owner, self.lock_timeout)
+            if acquired:
+                break
+            time.sleep(self.poll_interval)
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            if time.monotonic() > deadline:
+                logging.warning(f"Timed out waiting for cache lock on {key}; computing locally")
+                break
+
+        try:
+            # Another worker may have filled the key between our miss and the lock
+            value = self.get(key, _MISSING)
+            if value is not _MISSING:
+                return value
+            value = compute()
+            if cache_if is not None and not cache_if(value):
+                return value
+            try:
+                self.set(key, value, ttl)
+            except Exception as e:
+                logging.error(f"Error caching {key}: {e}")
+            return value
+        finally:
+            if acquired:
+                self._release(key, owner)
+
+    def _expires_at(self, ttl):
+        ttl = self.default_ttl if ttl is None else ttl
+        return time.time() + ttl if ttl else None
+
+
+class SQLiteCache(CacheBackend):
+    """
+    Cache stored in a SQLite file, shared by every process on the host.
+    Evicts expired entries first, then least recently used ones, to stay
+    within max_entries and max_bytes. Access times are only refreshed when
+    older than touch_interval seconds, so most reads take no write lock
+    and the LRU order is approximate.
+    """
+
+    def __init__(self, path, max_entries=10000, max_bytes=256 * 1024 * 1024, touch_interval=60, **kwargs):
+        super().__init__(**kwargs)
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.touch_interval = touch_interval
+        self._local = threading.local()
+
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            "key TEXT PRIMARY KEY, value BLOB NOT NULL, size INTEGER NOT NULL, "
+            "expires_at REAL, accessed_at REAL NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS locks ("
+            "key TEXT PRIMARY KEY, owner TEXT NOT NULL, expires_at REAL NOT NULL)"
+        )
+
+    def _connect(self):
+        # sqlite3 connections must not be shared between threads
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    def get(self, key, default=None):
+        conn = self._connect()
+        now = time.time()
+        row = conn.execute(
+            "SELECT value, expires_at, accessed_at FROM entries WHERE key = ?", (key,)
+        ).fetchone()
+        if row is None:
+            return default
+        value, expires_at, accessed_at = row
+        if expires_at is not None and expires_at <= now:
+            # Left for _evict on the next set, so reads stay lock-free
+            return default
+        if now - accessed_at > self.touch_interval:
+            conn.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (now, key))
+        return pickle.loads(value)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.max_bytes:
+            logging.warning(f"Not caching {key}: {len(data)} bytes exceeds the cache size limit")
+            return
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            conn.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, expires_at, accessed_at) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), self._expires_at(ttl), now)
+            )
+            self._evict(conn, now)
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+
+    def _evict(self, conn, now):
+        conn.execute("DELETE FROM entries WHERE expires_at IS NOT NULL AND expires_at <= ?", (now,))
+        count, total = conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM entries").fetchone()
+        if count <= self.max_entries and total <= self.max_bytes:
+            return
+        for key, size in conn.execute(
+            "SELECT key, size FROM entries ORDER BY accessed_at"
+        ).fetchall():
+            if count <= self.max_entries and total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM entries WHERE key = ?", (key,))
+            count -= 1
+            total -= size
+
+    def delete(self, key):
+        self._connect().execute("DELETE FROM entries WHERE key = ?", (key,))
+
+    def clear(self):
+        conn = self._connect()
+        conn.execute("DELETE FROM entries")
+        conn.execute("DELETE FROM locks")
+
+    def _acquire(self, key, owner, lease):
+        conn = self._connect()
+        now = time.time()
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            # Drop a lease left behind by a crashed worker
+            conn.execute("DELETE FROM locks WHERE key = ? AND expires_at <= ?", (key, now))
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO locks (key, owner, expires_at) VALUES (?, ?, ?)",
+                (key, owner, now + lease)
+            )
+            conn.execute("COMMIT")
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        return cursor.rowcount == 1
+
+    def _release(self, key, owner):
+        self._connect().execute("DELETE FROM locks WHERE key = ? AND owner = ?", (key, owner))
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache stored in Redis or any server speaking the Redis protocol.
+    TTLs use native key expiry; a sorted set of access times bounds the
+    number of entries with LRU eviction.
+    """
+
+    def __init__(self, url, prefix="streamlitchat", max_entries=10000, **kwargs):
+        super().__init__(**kwargs)
+        try:
+            import redis
+        except ImportError as e:
+            raise ImportError("RedisCache requires the 'redis' package: pip install redis") from e
+        self._redis = redis
+        self._client = redis.Redis.from_url(url)
+        self.prefix = prefix
+        self.max_entries = max_entries
+        self._index = f"{prefix}:index"
+
+    def _key(self, key):
+        return f"{self.prefix}:entry:{key}"
+
+    def _lock_key(self, key):
+        return f"{self.prefix}:lock:{key}"
+
+    def get(self, key, default=None):
+        data = self._client.get(self._key(key))
+        if data is None:
+            self._client.zrem(self._index, key)
+            return default
+        self._client.zadd(self._index, {key: time.time()})
+        return pickle.loads(data)
+
+    def set(self, key, value, ttl=None):
+        data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+        ttl = self.default_ttl if ttl is None else ttl
+        pipe = self._client.pipeline()
+        pipe.set(self._key(key), data, px=int(ttl * 1000) if ttl else None)
+        pipe.zadd(self._index, {key: time.time()})
+        pipe.zcard(self._index)
+        count = pipe.execute()[-1]
+        if count > self.max_entries:
+            evicted = self._client.zpopmin(self._index, count - self.max_entries)
+            if evicted:
+                self._client.delete(*[self._key(k.decode()) for k, _ in evicted])
+
+    def delete(self, key):
+        pipe = self._client.pipeline()
+        pipe.delete(self._key(key))
+        pipe.zrem(self._index, key)
+        pipe.execute()
+
+    def clear(self):
+        keys = list(self._client.scan_iter(f"{self.prefix}:*"))
+        if keys:
+            self._client.delete(*keys)
+
+    def _acquire(self, key, owner, lease):
+        return bool(self._client.set(self._lock_key(key), owner, nx=True, px=int(lease * 1000)))
+
+    def _release(self, key, owner):
+        # Compare-and-delete so we never drop a lock another worker now holds
+        lock_key = self._lock_key(key)
+        with self._client.pipeline() as pipe:
+            try:
+                pipe.watch(lock_key)
+                if pipe.get(lock_key) == owner.encode():
+                    pipe.multi()
+                    pipe.delete(lock_key)
+                    pipe.execute()
+            except self._redis.WatchError:
+                pass
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_cache_backend(url=None):
+    """
+    Return the shared cache backend for url (default: CACHE_URL), one instance per process
+    """
+    url = url or get_cache_url()
+    with _backends_lock:
+        backend = _backends.get(url)
+        if backend is None:
+            if url.startswith("sqlite:///"):
+                backend = SQLiteCache(url[len("sqlite:///"):])
+            elif url.startswith(("redis://", "rediss://", "unix://")):
+                backend = RedisCache(url)
+            else:
+                raise ValueError(f"Unsupported cache URL: {url}")
+            _backends[url] = backend
+        return backend
+
+
+def make_key(namespace, *args, **kwargs):
+    """
+    Build a cache key from a namespace and the call arguments
+    """
+    try:
+        payload = pickle.dumps((args, sorted(kwargs.items())), protocol=pickle.HIGHEST_PROTOCOL)
+    except Exception:
+        payload = repr((args, sorted(kwargs.items()))).encode()
+    return f"{namespace}:{hashlib.sha256(payload).hexdigest()}"
+
+
+def _is_not_none(value):
+    return value is not None
+
+
+def shared_cache(namespace=None, ttl=None, cache_if=_is_not_none):
+    """
+    Decorator caching a function's return value in the shared backend,
+    a cross-process counterpart to st.cache_data. Arguments and return
+    values must be picklable. Return values for which cache_if is false
+    (by default None, the usual failure result) are not cached. Falls back
+    to calling the function directly if the backend is unavailable.
+    """
+    def decorator(func):
+        prefix = namespace or f"{func.__module__}.{func.__qualname__}"
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            try:
+                backend = get_cache_backend()
+            except Exception as e:
+                logging.error(f"Shared cache unavailable: {e}")
+                return func(*args, **kwargs)
+            key = make_key(prefix, *args, **kwargs)
+            return backend.get_or_compute(key, lambda: func(*args, **kwargs), ttl, cache_if)
+
+        return wrapper
+    return decorator
@@ -6,6 +6,9 @@ import time
 import json
 import requests
 import base64
+from uuid import uuid4
+from shared_cache import shared_cache
+from message_store import MessageStore
 
 
 # Configure logging
@@ -83,7 +86,8 @@ def load_and_enhance_image(image_path, enhance=False):
         img = enhancer.enhance(1.8)
     return img
 
-@st.cache_data(show_spinner=False)
+# An empty dict means the file was missing or unreadable, so don't keep it
+@shared_cache(ttl=3600, cache_if=bool)
 def load_streamlit_updates():
     """Load the latest Streamlit updates from a local JSON file."""
     try:
@@ -93,6 +97,7 @@ def load_streamlit_updates():
         logging.error(f"Error loading JSON: {str(e)}")
         return {}
 
+@shared_cache(ttl=3600)
 def get_streamlit_api_code_version():
     """
     Get the current Streamlit API code version from the Streamlit API documentation.
@@ -118,7 +123,7 @@ def initialize_conversation():
     Initialize the conversation history with system and assistant messages.
 
     Returns:
-    - list: Initialized conversation history.
+    - MessageStore: Initialized conversation history.
     """
     assistant_message = "Hello! I am Streamly. How can I assist you with Streamlit today?"
 
@@ -130,9 +135,12 @@ def initialize_conversation():
         {"role": "system", "content": "You were created by Madie Laine, an OpenAI Researcher."},
         {"role": "assistant", "content": assistant_message}
     ]
-    return conversation_history
+    store = MessageStore(f"{st.session_state.session_id}:conversation-{uuid4()}")
+    for message in conversation_history:
+        store.append(message)
+    return store
 
-@st.cache_data(show_spinner=False)
+@shared_cache(ttl=3600)
 def get_latest_update_from_json(keyword, latest_updates):
     """
     Fetch the latest Streamlit update based on a keyword.
@@ -213,7 +221,7 @@ def on_chat_submit(chat_input, latest_updates):
         else:
             response = client.chat.completions.create(
                 model=model_engine,
-                messages=st.session_state.conversation_history
+                messages=list(st.session_state.conversation_history)
             )
             assistant_reply = response.choices[0].message.content
 
@@ -227,10 +235,12 @@ def on_chat_submit(chat_input, latest_updates):
 
 def initialize_session_state():
     """Initialize session state variables."""
+    if "session_id" not in st.session_state:
+        st.session_state.session_id = str(uuid4())
     if "history" not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = MessageStore(st.session_state.session_id)
     if 'conversation_history' not in st.session_state:
-        st.session_state.conversation_history = []
+        st.session_state.conversation_history = initialize_conversation()
 
 def main():
     """
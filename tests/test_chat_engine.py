@@ -0,0 +1,61 @@
+import asyncio
+
+import google.generativeai as genai
+import pytest
+from google.generativeai import protos
+from google.generativeai.types import generation_types
+
+from chat_engine import ChatEngine
+
+
+def _reply(text):
+    return protos.GenerateContentResponse(
+        candidates=[protos.Candidate(content=protos.Content(role="model", parts=[protos.Part(text=text)]))],
+        usage_metadata=protos.GenerateContentResponse.UsageMetadata(prompt_token_count=3, candidates_token_count=2),
+    )
+
+
+class FakeModel(genai.GenerativeModel):
+    """
+    A GenerativeModel that answers locally, so the real ChatSession is exercised
+    """
+
+    async def generate_content_async(self, contents, *, stream=False, **kwargs):
+        if not stream:
+            return generation_types.AsyncGenerateContentResponse.from_response(_reply("reply"))
+
+        async def chunks():
+            for i in range(5):
+                await asyncio.sleep(0.01)
+                yield _reply(f"chunk{i} ")
+
+        return await generation_types.AsyncGenerateContentResponse.from_aiterator(chunks())
+
+
+@pytest.fixture
+def engine():
+    engine = ChatEngine(persist=False)
+    yield engine
+    engine.shutdown()
+
+
+def test_closing_a_stream_early_keeps_the_chat_usable(engine):
+    chat = FakeModel("fake-model").start_chat(history=[])
+    assert engine.send_message(chat, "session", "hello", timeout=5) == "reply"
+
+    stream = engine.stream_message(chat, "session", "tell me more", timeout=5)
+    assert next(stream) == "chunk0 "
+    stream.close()
+
+    # The interrupted turn is dropped and the next message goes through
+    assert engine.send_message(chat, "session", "again", timeout=5) == "reply"
+    assert [content.parts[0].text for content in chat.history] == ["hello", "reply", "again", "reply"]
+    # Tokens of the partial stream are still charged
+    assert engine.ledger.totals("session")["total_tokens"] == 15
+
+
+def test_finished_stream_is_kept_in_history(engine):
+    chat = FakeModel("fake-model").start_chat(history=[])
+    assert "".join(engine.stream_message(chat, "session", "hi", timeout=5)) == "".join(f"chunk{i} " for i in range(5))
+    assert engine.send_message(chat, "session", "again", timeout=5) == "reply"
+    assert len(chat.history) == 4
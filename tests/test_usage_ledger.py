@@ -0,0 +1,33 @@
+import pytest
+
+from usage_ledger import BudgetExceeded, UsageLedger
+
+
+def test_load_counts_stored_usage_plus_unwritten_calls():
+    ledger = UsageLedger(budgets={"session_tokens": 100})
+    # Recorded while the earlier usage couldn't be read
+    ledger.record("session", None, "model", "chat", prompt_tokens=5, output_tokens=5)
+    assert not ledger.is_loaded("session")
+
+    ledger.load("session", totals={"prompt_tokens": 90, "output_tokens": 0, "images": 0})
+    assert ledger.is_loaded("session")
+    assert ledger.totals("session")["total_tokens"] == 100
+    assert ledger.today("session")["total_tokens"] == 10
+    with pytest.raises(BudgetExceeded):
+        ledger.check("session")
+
+
+def test_written_calls_are_not_counted_twice():
+    ledger = UsageLedger()
+    ledger.record("session", None, "model", "chat", prompt_tokens=5, output_tokens=5)
+    ledger.take_pending()
+    # The stored totals already include the written call
+    ledger.load("session", totals={"prompt_tokens": 5, "output_tokens": 5, "images": 0})
+    assert ledger.totals("session")["total_tokens"] == 10
+
+
+def test_reading_usage_does_not_track_the_session():
+    ledger = UsageLedger(max_sessions=1)
+    ledger.record("a", None, "model", "chat", prompt_tokens=1)
+    assert ledger.today("b")["total_tokens"] == 0
+    assert ledger.totals("a")["total_tokens"] == 1
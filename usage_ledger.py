@@ -0,0 +1,209 @@
+"""
+Per-session token and image usage with budget enforcement.
+
+The ledger keeps running totals per session (all time and for the current
+UTC day) in memory, so budget checks and usage displays cost a dict
+lookup. Every model call also produces a ledger entry (session, persona,
+model, tokens, images); ChatEngine writes pending entries to the
+usage_ledger collection in batches whenever it stores chat records, and
+loads a session's earlier totals from there the first time it sees it.
+Only the most recently active sessions are kept in memory; the others are
+loaded again when they come back.
+
+Budgets come from environment variables (unset means unlimited):
+- SESSION_TOKEN_BUDGET / SESSION_IMAGE_BUDGET: per session, all time
+- DAILY_TOKEN_BUDGET / DAILY_IMAGE_BUDGET: per session, per UTC day
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import datetime
+
+from bson import ObjectId
+
+# Pending entries kept while MongoDB is unavailable; the oldest are dropped beyond this
+MAX_PENDING_ENTRIES = 10000
+# Sessions whose totals are kept in memory; the least recently used are dropped beyond this
+MAX_SESSIONS = 10000
+
+
+def _budget_from_env(name):
+    value = os.environ.get(name)
+    return int(value) if value else None
+
+
+DEFAULT_BUDGETS = {
+    "session_tokens": _budget_from_env("SESSION_TOKEN_BUDGET"),
+    "session_images": _budget_from_env("SESSION_IMAGE_BUDGET"),
+    "daily_tokens": _budget_from_env("DAILY_TOKEN_BUDGET"),
+    "daily_images": _budget_from_env("DAILY_IMAGE_BUDGET"),
+}
+
+
+class BudgetExceeded(Exception):
+    """
+    Raised before a request that would exceed a session's usage budget
+    """
+
+
+def _empty_counters():
+    return {"prompt_tokens": 0, "output_tokens": 0, "images": 0}
+
+
+def _add(counters, prompt_tokens=0, output_tokens=0, images=0):
+    counters["prompt_tokens"] += prompt_tokens
+    counters["output_tokens"] += output_tokens
+    counters["images"] += images
+
+
+def _with_total(counters):
+    return {**counters, "total_tokens": counters["prompt_tokens"] + counters["output_tokens"]}
+
+
+def _today_counters(entry):
+    day = datetime.utcnow().date()
+    if entry["day"] != day:
+        entry["day"] = day
+        entry["today"] = _empty_counters()
+    return entry["today"]
+
+
+class UsageLedger:
+    """
+    Running usage totals per session plus a queue of entries to persist
+    """
+
+    def __init__(self, budgets=None, max_pending=MAX_PENDING_ENTRIES, max_sessions=MAX_SESSIONS):
+        self.budgets = {**DEFAULT_BUDGETS, **(budgets or {})}
+        self.max_pending = max_pending
+        self.max_sessions = max_sessions
+        self._lock = threading.Lock()
+        # session_id -> {"loaded", "totals", "day", "today"}, least recently used first;
+        # only the current UTC day's counters are kept
+        self._sessions = OrderedDict()
+        self._pending = []
+
+    def is_loaded(self, session_id):
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return entry is not None and entry["loaded"]
+
+    def load(self, session_id, totals=None, today=None):
+        """
+        Set a session's earlier usage (e.g. from MongoDB). Calls recorded
+        since that are still waiting to be written are added on top, while
+        calls already written are part of the loaded totals.
+        """
+        with self._lock:
+            entry = self._session(session_id)
+            if entry["loaded"]:
+                return
+            entry["loaded"] = True
+            entry["totals"] = _empty_counters()
+            entry["day"] = datetime.utcnow().date()
+            entry["today"] = _empty_counters()
+            if totals:
+                _add(entry["totals"], **totals)
+            if today:
+                _add(entry["today"], **today)
+            for pending in self._pending:
+                if pending["session_id"] != session_id:
+                    continue
+                counts = {field: pending[field] for field in ("prompt_tokens", "output_tokens", "images")}
+                _add(entry["totals"], **counts)
+                if pending["timestamp"].date() == entry["day"]:
+                    _add(entry["today"], **counts)
+
+    def record(self, session_id, persona, model, kind, prompt_tokens=0, output_tokens=0, images=0):
+        """
+        Add one model call to the session's totals and queue its ledger entry
+        """
+        entry = {
+            # Assigned up front so a retried write skips entries already stored
+            "_id": ObjectId(),
+            "session_id": session_id,
+            "timestamp": datetime.utcnow(),
+            "persona": persona,
+            "model": model,
+            "kind": kind,
+            "prompt_tokens": prompt_tokens,
+            "output_tokens": output_tokens,
+            "images": images,
+        }
+        with self._lock:
+            session = self._session(session_id)
+            _add(session["totals"], prompt_tokens, output_tokens, images)
+            _add(_today_counters(session), prompt_tokens, output_tokens, images)
+            self._pending.append(entry)
+            if len(self._pending) > self.max_pending:
+                del self._pending[:len(self._pending) - self.max_pending]
+        return entry
+
+    def totals(self, session_id):
+        """
+        All-time usage of a session seen by this process
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            return _with_total(dict(entry["totals"] if entry else _empty_counters()))
+
+    def today(self, session_id):
+        """
+        Usage of a session during the current UTC day
+        """
+        with self._lock:
+            entry = self._sessions.get(session_id)
+            if entry is None or entry["day"] != datetime.utcnow().date():
+                return _with_total(_empty_counters())
+            return _with_total(dict(entry["today"]))
+
+    def check(self, session_id, kind="chat"):
+        """
+        Raise BudgetExceeded if the session may not make another call of this kind
+        """
+        totals = self.totals(session_id)
+        today = self.today(session_id)
+        limits = [
+            ("session_tokens", totals["total_tokens"], "token budget for this session"),
+            ("daily_tokens", today["total_tokens"], "daily token budget"),
+        ]
+        if kind == "image":
+            limits += [
+                ("session_images", totals["images"], "image budget for this session"),
+                ("daily_images", today["images"], "daily image budget"),
+            ]
+        for name, used, label in limits:
+            limit = self.budgets.get(name)
+            if limit is not None and used >= limit:
+                raise BudgetExceeded(f"You have reached the {label} ({used} of {limit}).")
+
+    def take_pending(self):
+        """
+        Remove and return the entries waiting to be written
+        """
+        with self._lock:
+            entries, self._pending = self._pending, []
+        return entries
+
+    def restore_pending(self, entries):
+        """
+        Put back entries whose write failed, ahead of newer ones
+        """
+        with self._lock:
+            self._pending = (entries + self._pending)[-self.max_pending:]
+
+    def _session(self, session_id):
+        entry = self._sessions.get(session_id)
+        if entry is None:
+            entry = self._sessions[session_id] = {
+                "loaded": False,
+                "totals": _empty_counters(),
+                "day": datetime.utcnow().date(),
+                "today": _empty_counters(),
+            }
+            while len(self._sessions) > self.max_sessions:
+                # Dropped sessions are reloaded from the ledger collection when seen again
+                self._sessions.popitem(last=False)
+        else:
+            self._sessions.move_to_end(session_id)
+        return entry